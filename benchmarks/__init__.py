@@ -0,0 +1,10 @@
+"""
+Benchmarks for modone.
+
+    python -m benchmarks.run --output before.json
+    ... change something ...
+    python -m benchmarks.run --output after.json --compare before.json
+
+The corpora are generated from a fixed seed the first time they're needed and
+kept in --corpus-dir, so that runs are comparable.
+"""
@@ -0,0 +1,84 @@
+"""
+Generated corpora for the benchmarks.
+
+Every corpus is made of lines of random words, some of which contain the
+NEEDLE the benchmarks search for.  The words come from a seeded generator, so
+a corpus is the same every time it's built.
+"""
+
+import os
+import random
+import shutil
+
+
+NEEDLE = 'needle'
+
+# name -> (number of files, lines per file, words per line,
+#          fraction of lines with a match)
+CORPORA = {
+    'many-small-sparse': (2000, 40, 8, 0.01),
+    'many-small-dense': (2000, 40, 8, 0.5),
+    'few-huge-sparse': (3, 200000, 8, 0.0005),
+    'few-huge-dense': (3, 200000, 8, 0.2),
+    'long-lines': (20, 200, 800, 0.1),
+}
+
+# Smaller versions of the same corpora, for a quick check.
+QUICK_CORPORA = {
+    'many-small-sparse': (200, 40, 8, 0.01),
+    'many-small-dense': (200, 40, 8, 0.5),
+    'few-huge-sparse': (1, 50000, 8, 0.0005),
+    'few-huge-dense': (1, 50000, 8, 0.2),
+    'long-lines': (5, 100, 800, 0.1),
+}
+
+_WORDS = ['var', 'function', 'return', 'if', 'else', 'foo', 'bar', 'baz',
+          'require', 'module', 'exports', '=', '(', ')', '{', '}', ';',
+          'this', 'that', 'self', 'lines', 'path', 'index', 'query']
+
+
+def build(directory, name, quick=False):
+    """
+    Returns the paths of the files in corpus `name`, building it under
+    `directory` unless it's already there.
+    """
+    files, lines, words, density = (QUICK_CORPORA if quick else CORPORA)[name]
+    corpus_directory = os.path.join(
+        directory, '%s%s' % (name, '-quick' if quick else '')
+    )
+    paths = [os.path.join(corpus_directory, 'file%05d.js' % i)
+             for i in xrange(files)]
+    # Written last, so a half-built corpus is rebuilt.
+    done_marker = os.path.join(corpus_directory, '.done')
+    if os.path.exists(done_marker):
+        return paths
+
+    if os.path.exists(corpus_directory):
+        shutil.rmtree(corpus_directory)
+    os.makedirs(corpus_directory)
+    generator = random.Random(name)
+    for path in paths:
+        with open(path, 'w') as f:
+            for _ in xrange(lines):
+                f.write(_make_line(generator, words, density))
+    open(done_marker, 'w').close()
+    return paths
+
+
+def copy(paths, directory):
+    """
+    Copies the files at `paths` into `directory`, returning their new paths.
+    """
+    copies = []
+    for path in paths:
+        destination = os.path.join(directory, os.path.basename(path))
+        shutil.copyfile(path, destination)
+        copies.append(destination)
+    return copies
+
+
+def _make_line(generator, words, density):
+    line = [generator.choice(_WORDS) for _ in xrange(words)]
+    if generator.random() < density:
+        line[generator.randrange(words)] = NEEDLE
+    return ' '.join(line) + '\n'
@@ -0,0 +1,332 @@
+"""
+Runs the benchmarks, optionally saving the results as JSON and comparing them
+with an earlier run.  See `python -m benchmarks.run --help`.
+"""
+
+import argparse
+import fnmatch
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from benchmarks import corpora
+import modone
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (name, corpus names, function); see `case`.
+CASES = []
+
+
+def case(*corpus_names):
+    """
+    Registers the decorated function as a benchmark to run on each of the
+    given corpora.  It's called with the paths of the corpus's files and a
+    scratch directory, and returns (setup, run): `setup` (which may be None)
+    is called before each timed call of `run`.
+    """
+    def register(function):
+        CASES.append((function.__name__, corpus_names, function))
+        return function
+    return register
+
+
+ALL = tuple(sorted(corpora.CORPORA))
+HUGE = ('few-huge-sparse', 'few-huge-dense')
+
+
+def _read_all(paths):
+    contents = []
+    for path in paths:
+        with open(path) as f:
+            contents.append(f.readlines())
+    return contents
+
+
+@case(*ALL)
+def regex_suggestor(paths, scratch):
+    contents = _read_all(paths)
+    suggestor = modone.regex_suggestor(corpora.NEEDLE, 'pin')
+
+    def run():
+        for lines in contents:
+            for _ in suggestor(lines):
+                pass
+    return None, run
+
+
+@case(*ALL)
+def multiline_regex_suggestor(paths, scratch):
+    contents = _read_all(paths)
+    suggestor = modone.multiline_regex_suggestor(
+        r'%s(\s+\w+)' % corpora.NEEDLE, r'pin\1'
+    )
+
+    def run():
+        for lines in contents:
+            for _ in suggestor(lines):
+                pass
+    return None, run
+
+
+@case(*ALL)
+def multiline_non_overlapping(paths, scratch):
+    contents = _read_all(paths)
+    suggestor = modone.multiline_regex_suggestor(
+        r'%s.*?;' % corpora.NEEDLE, 'pin;', overlapping=False
+    )
+
+    def run():
+        for lines in contents:
+            for _ in suggestor(lines):
+                pass
+    return None, run
+
+
+@case('long-lines', *HUGE)
+def index_to_row_col(paths, scratch):
+    lines = _read_all(paths[:1])[0]
+    length = sum(len(line) for line in lines)
+    indices = range(0, length, max(1, length // 50))
+
+    def run():
+        for index in indices:
+            modone.base._index_to_row_col(lines, index)
+    return None, run
+
+
+@case('long-lines', *HUGE)
+def line_index_row_col(paths, scratch):
+    lines = _read_all(paths[:1])[0]
+    length = sum(len(line) for line in lines)
+    indices = range(0, length, max(1, length // 5000))
+
+    def run():
+        index = modone.base._LineIndex(lines)
+        for i in indices:
+            index.row_col(i)
+    return None, run
+
+
+@case(*ALL)
+def generate_patches(paths, scratch):
+    query = modone.Query(modone.regex_suggestor(corpora.NEEDLE, 'pin'),
+                         paths=paths)
+
+    def run():
+        for _ in query.generate_patches():
+            pass
+    return None, run
+
+
+@case(*ALL)
+def generate_patches_combined(paths, scratch):
+    query = modone.Query([
+        modone.regex_suggestor(corpora.NEEDLE, 'pin'),
+        modone.regex_suggestor(r'\bfoo\b', 'bar'),
+        modone.regex_suggestor(r'\bbaz\b', 'qux'),
+    ], paths=paths)
+
+    def run():
+        for _ in query.generate_patches():
+            pass
+    return None, run
+
+
+@case(*ALL)
+def count_matches(paths, scratch):
+    query = modone.Query(modone.regex_suggestor(corpora.NEEDLE))
+
+    def run():
+        for path in paths:
+            query.count_matches(path)
+    return None, run
+
+
+@case(*ALL)
+def apply_patches(paths, scratch):
+    query = modone.Query(modone.regex_suggestor(corpora.NEEDLE, 'pin'))
+    copies = []
+
+    def setup():
+        shutil.rmtree(scratch)
+        os.mkdir(scratch)
+        copies[:] = corpora.copy(paths, scratch)
+
+    def run():
+        for path in copies:
+            query.apply_patches(path)
+    return setup, run
+
+
+@case('many-small-sparse')
+def cli_startup(paths, scratch):
+    command = _modone_command('--count', corpora.NEEDLE, '--path', paths[0])
+    return None, lambda: _call(command)
+
+
+@case('many-small-dense', *HUGE)
+def cli_accept_all(paths, scratch):
+    paths_file = os.path.join(scratch, 'paths')
+    copies_directory = os.path.join(scratch, 'copies')
+    command = _modone_command('--paths-from', paths_file, '--accept-all',
+                              corpora.NEEDLE, 'pin')
+
+    def setup():
+        if os.path.exists(copies_directory):
+            shutil.rmtree(copies_directory)
+        os.mkdir(copies_directory)
+        with open(paths_file, 'w') as f:
+            for path in corpora.copy(paths, copies_directory):
+                f.write(path + '\n')
+    return setup, lambda: _call(command)
+
+
+def _modone_command(*arguments):
+    # Without the cache, every run does the same work.
+    return ([sys.executable, '-m', 'modone.base', '--no-cache'] +
+            list(arguments))
+
+
+def _call(command):
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [REPOSITORY] + filter(None, [environment.get('PYTHONPATH')])
+    )
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, stdout=devnull, env=environment)
+
+
+def run_benchmarks(corpus_directory, repeat=5, quick=False, only=None,
+                   output=sys.stdout):
+    """
+    Runs the benchmarks, returning {'case[corpus]': timings}, where timings
+    holds the best and median of `repeat` timed runs, in seconds.
+
+    @param only  If given, a glob; only benchmarks whose 'case[corpus]' name
+                 matches it are run.
+    """
+    results = {}
+    for name, corpus_names, function in CASES:
+        for corpus_name in corpus_names:
+            key = '%s[%s]' % (name, corpus_name)
+            if only is not None and not fnmatch.fnmatch(key, only):
+                continue
+            paths = corpora.build(corpus_directory, corpus_name, quick)
+            scratch = tempfile.mkdtemp(prefix='modone-benchmark-')
+            try:
+                setup, run = function(paths, scratch)
+                times = []
+                for _ in xrange(repeat):
+                    if setup is not None:
+                        setup()
+                    # (As timeit does, so that when the collector happens to
+                    # run doesn't count.)
+                    gc.collect()
+                    gc.disable()
+                    try:
+                        start = timeit.default_timer()
+                        run()
+                        times.append(timeit.default_timer() - start)
+                    finally:
+                        gc.enable()
+            finally:
+                shutil.rmtree(scratch)
+            times.sort()
+            results[key] = {
+                'best': times[0],
+                'median': times[len(times) // 2],
+                'repeat': repeat,
+            }
+            output.write('%-45s %10.4fs\n' % (key, times[0]))
+            output.flush()
+    return results
+
+
+def compare(results, baseline, threshold, output=sys.stdout):
+    """
+    Prints how the median time of each benchmark in both `results` and
+    `baseline` changed, and returns the names of those that got slower by
+    more than `threshold` (a fraction; 0.2 is 20%).  (The median is steadier
+    than the best time, which one lucky run can set.)
+    """
+    regressions = []
+    output.write('\n%-45s %10s %10s %8s\n' % ('', 'baseline', 'now', 'change'))
+    for key in sorted(set(results) & set(baseline)):
+        before, after = baseline[key]['median'], results[key]['median']
+        change = after / before - 1 if before else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(key)
+        output.write('%-45s %9.4fs %9.4fs %+7.1f%%%s\n' % (
+            key, before, after, change * 100, '  <--' if regressed else ''
+        ))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs modone\'s benchmarks.')
+    parser.add_argument('--corpus-dir', action='store', type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'modone-corpora'),
+                        help='Where to build and keep the generated corpora.')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='Number of timed runs of each benchmark; the '
+                             'median is compared (default 5).')
+    parser.add_argument('--quick', action='store_true',
+                        help='Use smaller corpora.')
+    parser.add_argument('--only', action='store', type=str, metavar='GLOB',
+                        help='Only run benchmarks whose name, like '
+                             '"regex_suggestor[long-lines]", matches GLOB.')
+    parser.add_argument('--output', action='store', type=str, metavar='FILE',
+                        help='Save the results to FILE as JSON.')
+    parser.add_argument('--compare', action='store', type=str, metavar='FILE',
+                        help='Compare the results with those saved in FILE, '
+                             'and exit with status 1 if any benchmark got '
+                             'slower by more than the threshold.')
+    parser.add_argument('--threshold', action='store', type=float,
+                        default=0.2,
+                        help='Allowed slowdown for --compare, as a fraction '
+                             '(default 0.2).')
+    arguments = parser.parse_args()
+
+    results = run_benchmarks(arguments.corpus_dir, arguments.repeat,
+                             arguments.quick, arguments.only)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'quick': arguments.quick,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('quick', False) != arguments.quick:
+            sys.stderr.write('warning: comparing --quick results with full '
+                             'ones\n')
+        regressions = compare(results, baseline['results'],
+                              arguments.threshold)
+        if regressions:
+            print '\n%d %s slower than %s by more than %d%%.' % (
+                len(regressions),
+                'benchmark is' if len(regressions) == 1 else 'benchmarks are',
+                arguments.compare, arguments.threshold * 100
+            )
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
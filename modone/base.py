@@ -19,16 +19,37 @@
 
 
 import argparse
+import array
+import bisect
+import collections
+import contextlib
+import errno
+import fnmatch
+import functools
+import heapq
+import itertools
+import json
 import os
 import re
+import signal
+import sre_constants
+import sre_parse
+import stat
 import sys
 import textwrap
+import thread
+import time
 from math import ceil
 
-def run_interactive(query, editor=None, just_count=False, default_no=False):
+def run_interactive(query, editor=None, just_count=False, default_no=False,
+                    fsync=False, quickfix=False):
     """
     Asks the user about each patch suggested by the result of the query.
 
+    Accepted patches are applied in memory, and each file is written out
+    (atomically) once its patches have all been reviewed, before the editor
+    is opened on it, or when the run is interrupted.
+
     @param query        An instance of the Query class.
     @param editor       Name of editor to use for manual intervention, e.g.
                         'vim'
@@ -36,26 +57,1283 @@ def run_interactive(query, editor=None, just_count=False, default_no=False):
                         environment variable.
     @param just_count   If true: don't run normally.  Just print out number of
                         places in the codebase where the query matches.
+    @param fsync        If true, make sure each file has reached the disk
+                        before moving on to the next.
+    @param quickfix     If true, matches with no suggested change aren't
+                        asked about one by one.  They are collected instead,
+                        and once every other patch has been reviewed, the
+                        editor is opened just once with all of them in its
+                        quickfix list (see run_quickfix_editor).
     """
 
     global yes_to_all  # noqa
 
+    if just_count:
+        run_count(query)
+        return
+
     # Okay, enough of this foolishness of computing start and end.
     # Let's ask the user about some one line diffs!
     print 'Searching for first instance...'
     suggestions = query.generate_patches()
 
-    if just_count:
-        for count, _ in enumerate(suggestions):
-            terminal_move_to_beginning_of_line()
-            print count,
-            sys.stdout.flush()  # since print statement ends in comma
+    buffer = None
+    flagged = []
+    try:
+        for patch in suggestions:
+            if patch.buffer is not buffer and buffer is not None:
+                buffer.flush(fsync)
+            buffer = patch.buffer
+            if quickfix and not patch.suggests_change:
+                # (Absolute, so that emacs finds it from the temporary
+                # directory.)
+                path = os.path.abspath(patch.path)
+                flagged.append((path, quickfix_line(
+                    patch, _patch_buffer(patch).lines, path
+                )))
+                continue
+            if _ask_about_patch(patch, editor, default_no) == 'n':
+                query.note_rejected(patch)
+            # (_ask_about_patch may have had to read the file itself.)
+            buffer = patch.buffer
+            print 'Searching...'
+    finally:
+        if buffer is not None:
+            buffer.flush(fsync)
+
+    if flagged:
+        _edit_flagged(flagged, editor)
+
+
+def _edit_flagged(flagged, editor):
+    """
+    Opens the editor once on `flagged`, a list of (path, quickfix line), then
+    reports which of the files were changed, as judged by their signatures.
+    """
+    paths = []
+    for path, _ in flagged:
+        if not paths or paths[-1] != path:
+            paths.append(path)
+    signatures = dict((path, _path_signature(path)) for path in paths)
+
+    import tempfile
+    quickfix_file = tempfile.NamedTemporaryFile(prefix='modone-',
+                                                suffix='.quickfix',
+                                                delete=False)
+    try:
+        with quickfix_file:
+            quickfix_file.writelines(line for _, line in flagged)
+        print '%d flagged %s in %d %s; opening the editor...' % (
+            len(flagged), 'match' if len(flagged) == 1 else 'matches',
+            len(paths), 'file' if len(paths) == 1 else 'files'
+        )
+        run_quickfix_editor(quickfix_file.name, editor)
+    finally:
+        os.unlink(quickfix_file.name)
+
+    changed = [path for path in paths
+               if _path_signature(path) != signatures[path]]
+    print 'Changed in the editor: %d of %d %s.' % (
+        len(changed), len(paths), 'file' if len(paths) == 1 else 'files'
+    )
+    for path in changed:
+        print '  %s' % path
+
+
+def run_count(query, as_json=False, update_interval=0.25):
+    """
+    Prints out the number of places where the query matches, without
+    constructing patches where it can be avoided (see Query.count_matches).
+
+    If standard output is a terminal, a running total is shown, redrawn at most
+    once every `update_interval` seconds.  Otherwise the count for each file
+    with matches is printed, followed by the total; as a JSON object if
+    `as_json`.
+
+    Returns the total.
+    """
+    interactive = sys.stdout.isatty() and not as_json
+    file_counts = []
+    total = 0
+    last_update = 0
+    for path, count in query.map_paths(query.count_matches):
+        if isinstance(count, Exception):
+            if interactive:
+                terminal_move_to_beginning_of_line()
+            sys.stderr.write('%s: %s\n' % (path, count))
+            continue
+        if not count:
+            if count == 0 and query.in_workers():
+                query.note_clean(path)
+            continue
+        total += count
+        if interactive:
+            now = time.time()
+            if now - last_update >= update_interval:
+                last_update = now
+                terminal_move_to_beginning_of_line()
+                print total,
+                sys.stdout.flush()  # since print statement ends in comma
+        elif as_json:
+            file_counts.append({'path': path, 'count': count})
+        else:
+            print '%s\t%d' % (path, count)
+
+    if interactive:
+        terminal_move_to_beginning_of_line()
+        print total
+    elif as_json:
+        json.dump({'files': file_counts, 'total': total}, sys.stdout)
         print
+    else:
+        print 'total\t%d' % total
+    return total
+
+
+def run_headless(query, jobs=1, fsync=False):
+    """
+    Applies every patch suggested by the result of the query, without asking.
+
+    Files are processed by a pool of `jobs` worker processes.  One line is
+    printed for each file that was changed, in the order in which the query
+    produced the paths, followed by a summary.
+
+    @param query        An instance of the Query class.
+    @param jobs         Number of worker processes to use.  With 1, files are
+                        processed in this process.
+    @param fsync        If true, make sure each file has reached the disk
+                        before it is reported as changed.
+
+    Returns the number of files changed and the number of patches applied.
+
+    Running in several workers prints and changes just what running in one
+    does:
+
+    >>> import shutil, tempfile, StringIO
+    >>> directory = tempfile.mkdtemp()
+    >>> names = ['%d.txt' % number for number in range(40)]
+    >>> for number, name in enumerate(names):
+    ...     with open(os.path.join(directory, name), 'w') as file_w:
+    ...         file_w.write('foo\\n' * (number % 3))
+    >>> def run(jobs):
+    ...     copy = tempfile.mkdtemp()
+    ...     for name in names:
+    ...         shutil.copy(os.path.join(directory, name), copy)
+    ...     paths = [os.path.join(copy, name) for name in names]
+    ...     stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    ...     try:
+    ...         result = run_headless(Query(regex_suggestor('foo', 'bar'),
+    ...                                     paths=paths), jobs)
+    ...         output = sys.stdout.getvalue().replace(copy, '')
+    ...     finally:
+    ...         sys.stdout = stdout
+    ...     return result, output, [open(path).read() for path in paths]
+    >>> serial = run(1)
+    >>> serial[0]
+    (26, 39)
+    >>> run(4) == serial
+    True
+    """
+    results = query.map_paths(
+        functools.partial(query.apply_patches, fsync=fsync), jobs
+    )
+
+    files_changed = patches_applied = patches_flagged = 0
+    for path, result in results:
+        if isinstance(result, Exception):
+            sys.stderr.write('%s: %s\n' % (path, result))
+            continue
+        if result is None:
+            continue
+        applied, flagged = result
+        if applied:
+            files_changed += 1
+            patches_applied += applied
+            _print_applied(path, applied)
+        elif not flagged and query.in_workers(jobs):
+            # (A worker's notes to the cache don't make it back here.)
+            query.note_clean(path)
+        patches_flagged += flagged
+
+    _print_applied_summary(files_changed, patches_applied)
+    if patches_flagged:
+        print '%d %s without a suggested change %s left alone.' % (
+            patches_flagged, 'match' if patches_flagged == 1 else 'matches',
+            'was' if patches_flagged == 1 else 'were'
+        )
+    return files_changed, patches_applied
+
+
+def _print_applied(path, applied):
+    print '%s: %d %s applied' % (
+        path, applied, 'patch' if applied == 1 else 'patches'
+    )
+
+
+def _print_applied_summary(files_changed, patches_applied):
+    print 'Applied %d %s to %d %s.' % (
+        patches_applied, 'patch' if patches_applied == 1 else 'patches',
+        files_changed, 'file' if files_changed == 1 else 'files'
+    )
+
+
+def run_export(query, format='jsonl', jobs=1, context=3):
+    """
+    Writes out every patch suggested by the result of the query, without
+    applying any of them, so that they can be reviewed and later applied with
+    `apply_patch_stream`.  Each file's patches are written as soon as the file
+    has been processed.
+
+    @param format   'jsonl' writes one JSON object per patch, with the path,
+                    the range of lines it replaces, the old and new lines, and
+                    a hash of the file's contents; 'diff' writes a unified diff
+                    of the changes, as if all of them had been accepted;
+                    'quickfix' writes a `path:line:column: text` line per
+                    patch, for vim's quickfix list or emacs's compilation
+                    mode (and can't be applied).
+    @param jobs     Number of worker processes to use (see run_headless).
+    @param context  Number of lines of context in a unified diff.
+
+    Returns the number of patches written.  If any file couldn't be
+    exported, exits with status 1 once the rest are written.
+    """
+    results = query.map_paths(
+        functools.partial(query.export_patches, format=format,
+                          context=context), jobs
+    )
+    exported = 0
+    failed = False
+    for path, result in results:
+        if isinstance(result, Exception):
+            sys.stderr.write('%s: %s\n' % (path, result))
+            failed = True
+            continue
+        if result is None:
+            continue
+        text, count = result
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        exported += count
+    if failed:
+        sys.exit(1)
+    return exported
+
+
+def run_apply_from(stream, fsync=False):
+    """
+    Applies the patches in `stream`, as written by run_export (in either
+    format), and prints a summary.  See apply_patch_stream.
+    """
+    files_changed = patches_applied = patches_skipped = 0
+    for path, applied, skipped, error in apply_patch_stream(stream, fsync):
+        if error is not None:
+            sys.stderr.write('%s: %s\n' % (path, error))
+        if skipped and error is None:
+            sys.stderr.write('%s: skipped %d conflicting %s\n' % (
+                path, skipped, 'patch' if skipped == 1 else 'patches'
+            ))
+        patches_skipped += skipped
+        if applied:
+            files_changed += 1
+            patches_applied += applied
+            _print_applied(path, applied)
+    _print_applied_summary(files_changed, patches_applied)
+    if patches_skipped:
+        print 'Skipped %d %s.' % (
+            patches_skipped, 'patch' if patches_skipped == 1 else 'patches'
+        )
+    return files_changed, patches_applied
+
+
+def run_serve(socket_path, cache=None):
+    """
+    Runs `serve`, saying so and exiting if it can't listen on `socket_path`
+    (e.g. because another server already is).
+    """
+    try:
+        serve(socket_path, cache)
+    except EnvironmentError as e:
+        message = e.strerror or str(e)
+        if socket_path not in message:
+            message = '%s: %s' % (socket_path, message)
+        sys.stderr.write('modone --serve: %s\n' % message)
+        sys.exit(2)
+
+
+def apply_patch_stream(stream, fsync=False):
+    """
+    Applies the patches read from `stream`, which holds either JSON lines or
+    a unified diff as written by run_export, writing each file once.
+
+    Before a file is changed, the patches are checked against it: for JSON
+    lines, by the hash of the file's contents, and by each patch's old lines;
+    for a diff, by each hunk's old and context lines.  If they don't match,
+    the file was changed since the patches were made, and none of them are
+    applied to it.  Patches that overlap one applied before them are
+    skipped.
+
+    Generates (path, number of patches applied, number skipped, error) for
+    each file, where error is None or a message saying why nothing was
+    applied.
+
+    >>> import tempfile, StringIO
+    >>> path = os.path.join(tempfile.mkdtemp(), 'a.sql')
+    >>> query = Query(regex_suggestor('-- old|old', '++ new'), path=path)
+    >>> for format in ('diff', 'jsonl'):
+    ...     with open(path, 'wb') as file_w:
+    ...         file_w.write('-- old\\ncaf\\xe9 old\\n')
+    ...     text, count = query.export_patches(path, format)
+    ...     for _, applied, skipped, error in apply_patch_stream(
+    ...             StringIO.StringIO(text)):
+    ...         print format, count, applied, skipped, error
+    ...     print repr(open(path, 'rb').read())
+    diff 2 1 0 None
+    '++ new\\ncaf\\xe9 ++ new\\n'
+    jsonl 2 2 0 None
+    '++ new\\ncaf\\xe9 ++ new\\n'
+    """
+    first_line = stream.readline()
+    lines = itertools.chain([first_line], iter(stream.readline, ''))
+    if first_line.lstrip().startswith('{'):
+        groups = _read_jsonl_patches(lines)
+    else:
+        groups = _read_diff_patches(lines)
+
+    for path, content_hash, patches in groups:
+        try:
+            buffer = FileBuffer(path)
+        except IOError as e:
+            yield path, 0, len(patches), e
+            continue
+        snapshot = list(buffer.lines)
+        if (content_hash is not None and
+                content_hash != _content_hash(snapshot)):
+            yield path, 0, len(patches), 'file has changed; skipped'
+            continue
+        index = None
+        for patch, old_lines in patches:
+            if isinstance(patch, SpanPatch):
+                if index is None:
+                    index = _LineIndex(snapshot)
+                if patch.end > len(index.text):
+                    old_lines = None
+                else:
+                    patch.locate(index)
+            if (old_lines is None or old_lines != snapshot[
+                    patch.start_line_number:patch.end_line_number]):
+                yield path, 0, len(patches), 'file has changed; skipped'
+                break
+        else:
+            edits = _EditTracker(buffer, snapshot)
+            applied = skipped = 0
+            for patch, _ in patches:
+                original = edits.rebase(patch)
+                if original is None:
+                    skipped += 1
+                    continue
+                buffer.apply(patch)
+                edits.record(patch, original)
+                applied += 1
+            buffer.flush(fsync)
+            yield path, applied, skipped, None
+
+
+def _read_jsonl_patches(lines):
+    """
+    Generates (path, content hash, [(patch, old lines)]) for each file in the
+    JSON lines written by Query.export_patches.  Flagged matches are left
+    out.
+    """
+    records = (_decode_message(line) for line in lines if line.strip())
+    for path, file_records in itertools.groupby(
+            records, key=lambda record: record['path']):
+        patches = []
+        content_hash = None
+        for record in file_records:
+            content_hash = record['hash']
+            if record['new_lines'] is None:
+                continue
+            if 'span' in record:
+                patch = SpanPatch(record['span'][0], record['span'][1],
+                                  record['replacement'])
+            else:
+                patch = Patch(record['start'], record['end'],
+                              record['new_lines'])
+            patches.append((patch, record['old_lines']))
+        yield path, content_hash, patches
+
+
+_HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+def _read_diff_patches(lines):
+    """
+    Generates (path, None, [(patch, old lines)]) for each file in a unified
+    diff, with one patch per hunk.  Each hunk's body is as long as its header
+    says, so that removed and added lines that look like file headers are
+    read as the lines they are.
+    """
+    path = None
+    patches = []
+    old_lines = new_lines = None
+    # How many of the current hunk's old and new lines are still to come.
+    old_left = new_left = 0
+    line_kind = ' '
+    for line in lines:
+        if line.startswith('\\'):
+            # "\ No newline at end of file" applies to the previous line.
+            if old_lines and line_kind in ' -':
+                old_lines[-1] = old_lines[-1].rstrip('\n')
+            if new_lines and line_kind in ' +':
+                new_lines[-1] = new_lines[-1].rstrip('\n')
+            continue
+        if old_left > 0 or new_left > 0:
+            line_kind = line[:1]
+            if line_kind not in ' -+':
+                # (A blank context line whose space got stripped.)
+                line_kind, line = ' ', ' ' + line
+            if line_kind in ' -':
+                old_lines.append(line[1:])
+                old_left -= 1
+            if line_kind in ' +':
+                new_lines.append(line[1:])
+                new_left -= 1
+            continue
+        if line.startswith('--- '):
+            continue
+        if line.startswith('+++ '):
+            if path is not None:
+                yield path, None, patches
+            path = line[4:].rstrip('\n').split('\t')[0]
+            if path.startswith('b/'):
+                path = path[2:]
+            patches = []
+            continue
+        match = _HUNK_HEADER.match(line)
+        if match:
+            old_start = int(match.group(1))
+            old_left = int(match.group(2) or 1)
+            new_left = int(match.group(4) or 1)
+            if old_left:
+                old_start -= 1
+            old_lines, new_lines = [], []
+            patches.append((
+                Patch(old_start, old_start + old_left, new_lines), old_lines
+            ))
+    if path is not None:
+        yield path, None, patches
+
+
+def _map_paths(function, paths, jobs=1):
+    """
+    Generates (path, function(path)) for each of `paths`, in order.  If
+    `function` raises an EnvironmentError, that is generated in place of its
+    result.
+
+    If jobs > 1, `function` is called in a pool of that many worker processes.
+    They are forked, so they inherit it; it usually involves a suggestor, and
+    suggestors are usually closures, which can't be pickled.
+    """
+    global _worker_function
+
+    if jobs <= 1:
+        for path in paths:
+            yield _call_worker_function(path, function)
         return
 
-    for patch in suggestions:
-        _ask_about_patch(patch, editor, default_no)
-        print 'Searching...'
+    import multiprocessing
+    _worker_function = function
+    pool = multiprocessing.Pool(jobs)
+    try:
+        if _stats is None:
+            for result in pool.imap(_call_worker_function, paths,
+                                    chunksize=16):
+                yield result
+            return
+        for path, result, stats in pool.imap(
+                _call_worker_function_with_stats, paths, chunksize=16):
+            _stats.merge(stats)
+            yield path, result
+    finally:
+        pool.terminate()
+        _worker_function = None
+
+
+_worker_function = None
+
+
+def _call_worker_function(path, function=None):
+    try:
+        return path, (function or _worker_function)(path)
+    except (EnvironmentError, UnicodeError) as e:
+        return path, e
+
+
+def _call_worker_function_with_stats(path):
+    # Each call sends back just its own stats, for the parent to merge.
+    global _stats
+    _stats = Stats()
+    return _call_worker_function(path) + (_stats,)
+
+
+class TimeBudgetExceeded(Exception):
+    """
+    Takes the place of the result for a file that was skipped because looking
+    at it took longer than a Query's file_budget, or spent longer than its
+    match_budget on a single match.
+
+    `start_line` (counting from 0) is where matching had got to, if known:
+    the line being matched, or, for a multiline search (`end_line` None),
+    the line where the search started.
+    """
+
+    def __init__(self, path, kind, budget, size, start_line=None,
+                 end_line=None):
+        Exception.__init__(self, path, kind, budget, size, start_line,
+                           end_line)
+        self.path = path
+        self.kind = kind
+        self.budget = budget
+        self.size = size
+        self.start_line = start_line
+        self.end_line = end_line
+
+    def __str__(self):
+        if self.start_line is None:
+            where = 'position unknown'
+        elif self.end_line is None:
+            where = 'searching from line %d' % (self.start_line + 1)
+        elif self.end_line - self.start_line <= 1:
+            where = 'at line %d' % (self.start_line + 1)
+        else:
+            where = 'at lines %d-%d' % (self.start_line + 1, self.end_line)
+        return 'skipped, over the %gs %s time budget (%s bytes, %s)' % (
+            self.budget, 'per-match' if self.kind == 'match' else 'per-file',
+            '?' if self.size is None else self.size, where
+        )
+
+
+# In a worker of _watched_map_paths, where matching has got to, as [unit,
+# position]; see _watched_lines, _watched_matches and _watched_spans.
+_progress = None
+
+_NO_PROGRESS, _LINE_PROGRESS, _OFFSET_PROGRESS = range(3)
+
+
+def _watched_lines(lines, progress):
+    # Yields `lines`, recording the number of each in `progress`.
+    progress[0] = _LINE_PROGRESS
+    for row, line in enumerate(lines):
+        progress[1] = row
+        yield line
+
+
+def _watched_matches(matches, progress):
+    # Yields `matches`, recording roughly where the search for the next one
+    # starts.
+    progress[0] = _OFFSET_PROGRESS
+    progress[1] = 0
+    for match in matches:
+        yield match
+        progress[1] = match.start()
+
+
+def _watched_spans(spans, progress):
+    # Yields the (start, end) offsets `spans` of lines, recording the start of
+    # each while it's looked at, and then its end, where the search for the
+    # next one starts.
+    progress[0] = _OFFSET_PROGRESS
+    progress[1] = 0
+    for start, end in spans:
+        progress[1] = start
+        yield start, end
+        progress[1] = end
+
+
+def _watched_map_paths(function, paths, jobs, file_budget, match_budget):
+    """
+    Like _map_paths, but each file is looked at in a worker process (even if
+    jobs is 1) that is killed if it spends more than `file_budget` seconds on
+    the file, or more than `match_budget` seconds without making progress
+    (see _progress).  A TimeBudgetExceeded is generated in place of the
+    result for such a file, and the rest carry on in a new worker.
+
+    Each engine makes progress a line (or match) at a time, so a file that
+    is slow but not stuck gets the whole of the file budget:
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> for name, text in [('slow.txt', 'x\\n' * 20),
+    ...                    ('stuck.txt', 'x\\nx\\nstuck\\nx\\n')]:
+    ...     with open(os.path.join(directory, name), 'w') as file_w:
+    ...         file_w.write(text)
+    >>> def change(line):
+    ...     time.sleep(0.02)
+    ...     while line == 'stuck\\n':
+    ...         time.sleep(1)
+    ...     return line.upper()
+    >>> paths = [os.path.join(directory, name)
+    ...          for name in ('slow.txt', 'stuck.txt')]
+    >>> for engine in ('lines', 'mmap', 'stream'):
+    ...     query = Query(line_transformation_suggestor(change), paths=paths,
+    ...                   engine=engine, match_budget=0.2)
+    ...     for path, result in query.map_paths(query.count_matches):
+    ...         if isinstance(result, TimeBudgetExceeded):
+    ...             result = 'skipped at line %d' % (result.start_line + 1)
+    ...         print engine, os.path.basename(path), result
+    lines slow.txt 20
+    lines stuck.txt skipped at line 3
+    mmap slow.txt 20
+    mmap stuck.txt skipped at line 3
+    stream slow.txt 20
+    stream stuck.txt skipped at line 3
+    """
+    global _worker_function
+    import select
+
+    _worker_function = function
+    workers = []
+    try:
+        workers = [_WatchedWorker() for _ in xrange(max(1, jobs))]
+        paths = iter(paths)
+        exhausted = False
+        # Results that came in ahead of their turn, by index.
+        results = {}
+        next_index = dispatched = 0
+        while True:
+            for worker in workers:
+                # (Not too far ahead of the results generated, since they're
+                # held until it's their turn.)
+                if (worker.task is None and not exhausted and
+                        dispatched - next_index < 16 * len(workers)):
+                    try:
+                        path = next(paths)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    worker.start(dispatched, path)
+                    dispatched += 1
+
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+            busy = [worker for worker in workers if worker.task is not None]
+            if not busy:
+                if exhausted:
+                    return
+                continue
+
+            ready, _, _ = select.select([worker.connection for worker in busy],
+                                        [], [], 0.05)
+            now = time.time()
+            for number, worker in enumerate(workers):
+                if worker.task is None:
+                    continue
+                index, path = worker.task[:2]
+                if worker.connection in ready:
+                    try:
+                        result = worker.connection.recv()
+                    except EOFError:
+                        worker.stop()
+                        workers[number] = _WatchedWorker()
+                        result = (path, EnvironmentError(
+                            'the worker process died'))
+                    else:
+                        worker.task = None
+                        if len(result) == 3:
+                            _stats.merge(result[2])
+                            result = result[:2]
+                    results[index] = result
+                    continue
+                exceeded = worker.check(now, file_budget, match_budget)
+                if exceeded is not None:
+                    workers[number] = _WatchedWorker()
+                    results[index] = (path, exceeded)
+    finally:
+        for worker in workers:
+            worker.stop()
+        _worker_function = None
+
+
+class _WatchedWorker(object):
+    """
+    A worker process for _watched_map_paths, which calls _worker_function on
+    one path at a time.
+    """
+
+    def __init__(self):
+        import multiprocessing
+
+        self.progress = multiprocessing.RawArray('l', 2)
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_run_watched_worker,
+            args=(child_connection, self.progress)
+        )
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+        # (index, path, when it was started, the last progress seen, and when
+        # that changed)
+        self.task = None
+
+    def start(self, index, path):
+        self.progress[0] = _NO_PROGRESS
+        self.connection.send(path)
+        now = time.time()
+        self.task = (index, path, now, (_NO_PROGRESS, 0), now)
+
+    def check(self, now, file_budget, match_budget):
+        """
+        Returns a TimeBudgetExceeded, after stopping the worker, if its
+        current file has run over budget.
+        """
+        index, path, started, last_progress, changed = self.task
+        progress = tuple(self.progress)
+        if progress != last_progress:
+            self.task = (index, path, started, progress, now)
+            changed = now
+        if file_budget is not None and now - started > file_budget:
+            kind, budget = 'file', file_budget
+        elif match_budget is not None and now - changed > match_budget:
+            kind, budget = 'match', match_budget
+        else:
+            return None
+
+        self.stop()
+        start_line = end_line = None
+        unit, position = tuple(self.progress)
+        if unit == _LINE_PROGRESS:
+            start_line, end_line = position, position + 1
+        elif unit == _OFFSET_PROGRESS:
+            start_line = _line_at_offset(path, position)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        return TimeBudgetExceeded(path, kind, budget, size, start_line,
+                                  end_line)
+
+    def stop(self):
+        if self.process.is_alive():
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.join()
+        self.connection.close()
+        self.task = None
+
+
+def _run_watched_worker(connection, progress):
+    global _progress
+    # Interrupting is up to the parent, which kills its workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _progress = progress
+    call = (_call_worker_function if _stats is None
+            else _call_worker_function_with_stats)
+    while True:
+        try:
+            path = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = call(path)
+        except Exception as e:
+            result = (path, e)
+        connection.send(result)
+
+
+def _line_at_offset(path, offset):
+    # The number of the line (from 0) with the given offset in it, or None.
+    try:
+        with open(path) as file_r:
+            return file_r.read(offset).count('\n')
+    except IOError:
+        return None
+
+
+def default_socket_path():
+    """Where `modone --serve` listens, and modone-client connects."""
+    import tempfile
+    directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(directory, 'modone-%d.sock' % os.getuid())
+
+
+def serve(socket_path, cache=None, max_suggestors=64, max_buffers=256):
+    """
+    Answers queries sent over the Unix socket at `socket_path` (see
+    query_server) until interrupted, one at a time.  Suggestors, with their
+    compiled regexes, and the FileBuffers they were run over are kept between
+    queries, up to `max_suggestors` and `max_buffers` of each, so a query for
+    a single file costs little more than the work itself.  Raises
+    socket.error if another server is already running there.
+
+    @param cache  A ScanCache for the queries to use (see Query), saved when
+                  the server stops.
+    """
+    listener = _listen(socket_path,
+                       _QueryServer(cache, max_suggestors, max_buffers))
+    # So that the socket is cleaned up after `kill` too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        listener.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.server_close()
+        os.unlink(socket_path)
+        if cache is not None:
+            cache.save()
+
+
+def _listen(socket_path, server):
+    r"""
+    Returns a SocketServer listening on `socket_path`, with connections
+    handled by a _QueryServer.  A socket left behind by a server that's gone
+    is replaced; raises socket.error if a server is still answering there.
+
+    >>> import tempfile, threading
+    >>> directory = tempfile.mkdtemp()
+    >>> socket_path = os.path.join(directory, 'modone.sock')
+    >>> with open(os.path.join(directory, 'a.txt'), 'w') as file_w:
+    ...     file_w.write('foo\nbar foo\n')
+    >>> listener = _listen(socket_path, _QueryServer(None, 4, 4))
+    >>> thread = threading.Thread(target=listener.serve_forever)
+    >>> thread.start()
+    >>> query_server(socket_path, {'mode': 'count', 'pattern': 'fo+',
+    ...                            'cwd': directory, 'paths': ['a.txt']})
+    {'results': [{'count': 2, 'path': 'a.txt'}]}
+    >>> serve(socket_path)    # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    error: [Errno ...] a modone server is already running at .../modone.sock
+    >>> listener.shutdown()
+    >>> thread.join()
+    >>> listener.server_close()
+
+    Once it's gone, its socket is taken over:
+
+    >>> listener = _listen(socket_path, _QueryServer(None, 4, 4))
+    >>> listener.server_close()
+    >>> os.unlink(socket_path)
+    """
+    import socket
+    import SocketServer
+    try:
+        stale = stat.S_ISSOCK(os.stat(socket_path).st_mode)
+    except OSError:
+        stale = False
+    if stale:
+        try:
+            query_server(socket_path, {'mode': 'ping'})
+        except socket.error:
+            # Left behind by a server that's gone.
+            os.unlink(socket_path)
+        else:
+            raise socket.error(errno.EADDRINUSE,
+                               'a modone server is already running at %s' %
+                               socket_path)
+    # Only the user may connect.
+    umask = os.umask(0o077)
+    try:
+        return SocketServer.UnixStreamServer(socket_path, server.handle)
+    finally:
+        os.umask(umask)
+
+
+class _QueryServer(object):
+    # What a server keeps between queries.
+
+    def __init__(self, cache, max_suggestors, max_buffers):
+        self.cache = cache
+        self.suggestors = _LRU(max_suggestors)
+        self.buffers = _LRU(max_buffers)
+
+    def handle(self, connection, address, listener):
+        """
+        Answers the requests on a connection (see _listen): each line is a
+        request, answered with a line.
+        """
+        rfile = connection.makefile('rb')
+        wfile = connection.makefile('wb', 0)
+        try:
+            for line in iter(rfile.readline, ''):
+                try:
+                    response = self.answer(_decode_message(line))
+                except (ValueError, TypeError, KeyError, AttributeError) as e:
+                    response = {'error': str(e)}
+                wfile.write(_encode_message(response))
+        finally:
+            rfile.close()
+            wfile.close()
+
+    def answer(self, request):
+        """
+        Returns the response to a request (see query_server).
+        """
+        mode = request.get('mode', 'count')
+        if mode == 'ping':
+            return {}
+        if mode not in ('count', 'export', 'apply'):
+            raise ValueError('unknown mode %r' % mode)
+        if request.get('cwd') is not None:
+            # Queries are answered one at a time, so paths can be left as
+            # the client gave them, and show up in the output that way.
+            try:
+                os.chdir(request['cwd'])
+            except OSError as e:
+                raise ValueError(str(e))
+        query = Query(self._suggestor(request), cache=self.cache,
+                      buffers=self.buffers)
+        results = []
+        for path in request.get('paths', []):
+            result = {'path': path}
+            try:
+                if mode == 'count':
+                    answer = query.count_matches(path)
+                elif mode == 'export':
+                    answer = query.export_patches(
+                        path, request.get('format', 'jsonl'),
+                        request.get('context', 3)
+                    )
+                else:
+                    answer = query.apply_patches(path,
+                                                 request.get('fsync', False))
+            except (EnvironmentError, UnicodeError) as e:
+                answer = e
+            if answer is None:
+                result['error'] = 'couldn\'t read the file'
+            elif isinstance(answer, Exception):
+                result['error'] = str(answer)
+            elif mode == 'count':
+                result['count'] = answer
+            elif mode == 'export':
+                result['output'], result['patches'] = answer
+            else:
+                result['applied'], result['flagged'] = answer
+            results.append(result)
+        return {'results': results}
+
+    def _suggestor(self, request):
+        if not request.get('pattern'):
+            raise ValueError('no pattern')
+        multiline = bool(request.get('multiline'))
+        overlapping = request.get('overlapping')
+        if overlapping is None:
+            overlapping = request.get('mode') != 'apply'
+        key = (request['pattern'], request.get('substitution'), multiline,
+               bool(request.get('ignore_case')), bool(overlapping))
+        suggestor = self.suggestors.get(key)
+        if suggestor is None:
+            pattern, substitution, _, ignore_case, overlapping = key
+            try:
+                if multiline:
+                    suggestor = multiline_regex_suggestor(
+                        pattern, substitution, ignore_case, overlapping
+                    )
+                else:
+                    suggestor = regex_suggestor(pattern, substitution,
+                                                ignore_case)
+            except re.error as e:
+                raise ValueError('bad pattern: %s' % e)
+            self.suggestors[key] = suggestor
+        return suggestor
+
+
+def query_server(socket_path, request):
+    """
+    Sends `request` to the server listening on `socket_path` (see serve), and
+    returns its response.  Raises socket.error if there's no server.
+
+    A request is a dict with a 'mode', one of 'count', 'export' (with a
+    'format' and 'context', as for run_export) or 'apply' (and 'fsync'), the
+    'paths' to look at, relative to 'cwd' (the client's working directory),
+    and a 'pattern' with optionally a 'substitution', 'multiline',
+    'ignore_case' and 'overlapping' (see multiline_regex_suggestor).  The
+    response has either an 'error', or 'results': for each path, a dict with
+    the 'path' and either an 'error', the 'count', the 'output' and number of
+    'patches', or the numbers 'applied' and 'flagged'.
+
+    Strings are sent as JSON, each byte as the character with that code, so
+    that files in any encoding make it through unchanged.
+    """
+    import socket
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendall(_encode_message(request))
+        connection.shutdown(socket.SHUT_WR)
+        response = connection.makefile('rb').readline()
+    finally:
+        connection.close()
+    if not response:
+        raise socket.error('the server hung up')
+    return _decode_message(response)
+
+
+def _encode_message(message):
+    # (Also how exported patches are written; see _read_jsonl_patches.)
+    return json.dumps(message, encoding='latin-1', sort_keys=True) + '\n'
+
+
+def _decode_message(line):
+    r"""
+    >>> _decode_message(_encode_message({'a': ['\xff\n', 1, None]}))
+    {'a': ['\xff\n', 1, None]}
+    """
+    def to_bytes(value):
+        if isinstance(value, unicode):
+            return value.encode('latin-1')
+        if isinstance(value, list):
+            return [to_bytes(item) for item in value]
+        if isinstance(value, dict):
+            return dict((to_bytes(key), to_bytes(item))
+                        for key, item in value.iteritems())
+        return value
+    return to_bytes(json.loads(line))
+
+
+class _LRU(object):
+    """
+    A mapping that holds at most `max_entries`, forgetting the least recently
+    used first.
+
+    >>> cache = _LRU(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache.get('a')
+    1
+    >>> cache['c'] = 3
+    >>> cache.get('b'), len(cache)
+    (None, 2)
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            return default
+        self._entries[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Stats(object):
+    """
+    Where the time went during a run, and how much was read and written; see
+    enable_stats.
+
+    Time is kept per phase ('read', 'prefilter', 'match', 'apply', 'write',
+    'draw', 'prompt', 'editor', ...), as wall-clock and CPU seconds.  A phase
+    that runs inside another is only counted once, in the inner phase.
+    Files are charged with the time spent in every phase but the user's
+    ('prompt' and 'editor') from when they're read until the next file is
+    read by the same thread.
+
+    >>> stats = Stats()
+    >>> started = stats.start()
+    >>> inner = stats.start()
+    >>> stats.stop('read', inner)
+    >>> stats.stop('match', started)
+    >>> sorted(stats.wall)
+    ['match', 'read']
+    >>> stats.count('patches_accepted', 2)
+    >>> stats.counters['patches_accepted']
+    2
+
+    Time is charged to the file the timing thread read last:
+
+    >>> import threading
+    >>> stats.opened('a.txt', 10)
+    >>> prefetch = threading.Thread(target=stats.opened, args=('b.txt', 5))
+    >>> prefetch.start(); prefetch.join()
+    >>> stats.stop('match', stats.start())
+    >>> sorted(stats.file_times)
+    ['a.txt']
+    """
+
+    USER_PHASES = ('prompt', 'editor')
+    # reads_saved counts the times a FileBuffer was used where the file would
+    # otherwise have been read again; files_prefiltered and files_cached, the
+    # files a Query skipped because of its prefilter or its ScanCache.
+    COUNTERS = ('files_opened', 'files_reread', 'reads_saved',
+                'files_prefiltered', 'files_cached', 'bytes_read',
+                'bytes_written', 'patches_suggested', 'patches_accepted')
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.file_times = {}
+        self.started = time.time(), time.clock()
+        # Time spent in phases nested in each of the ones running now, and the
+        # file last read, by thread (see _Prefetcher).
+        self._nested = {}
+        self._paths = {}
+
+    def start(self):
+        self._nested.setdefault(thread.get_ident(), []).append([0.0, 0.0])
+        return time.time(), time.clock()
+
+    def stop(self, phase, started):
+        wall = time.time() - started[0]
+        cpu = time.clock() - started[1]
+        ident = thread.get_ident()
+        nested = self._nested[ident]
+        nested_wall, nested_cpu = nested.pop()
+        if nested:
+            nested[-1][0] += wall
+            nested[-1][1] += cpu
+        wall -= nested_wall
+        self.wall[phase] = self.wall.get(phase, 0.0) + wall
+        self.cpu[phase] = self.cpu.get(phase, 0.0) + cpu - nested_cpu
+        path = self._paths.get(ident)
+        if path is not None and phase not in self.USER_PHASES:
+            self.file_times[path] = self.file_times.get(path, 0.0) + wall
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def opened(self, path, size):
+        """Records that the file at `path`, of `size` bytes, was read."""
+        self._paths[thread.get_ident()] = path
+        self.counters['files_opened'] += 1
+        self.counters['bytes_read'] += size
+
+    def timed(self, phase, iterable):
+        """
+        Generates the items of `iterable`, charging the time taken to produce
+        each to `phase`.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = self.start()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.stop(phase, started)
+            yield item
+
+    def merge(self, other):
+        """Adds in the Stats of another process (e.g. a worker)."""
+        for phase, seconds in other.wall.iteritems():
+            self.wall[phase] = self.wall.get(phase, 0.0) + seconds
+        for phase, seconds in other.cpu.iteritems():
+            self.cpu[phase] = self.cpu.get(phase, 0.0) + seconds
+        for counter, amount in other.counters.iteritems():
+            self.counters[counter] += amount
+        for path, seconds in other.file_times.iteritems():
+            self.file_times[path] = self.file_times.get(path, 0.0) + seconds
+
+    def slowest_files(self, number=10):
+        return heapq.nlargest(number, self.file_times.iteritems(),
+                              key=lambda item: item[1])
+
+    def to_json(self, slowest=10):
+        return {
+            'elapsed': {
+                'wall': time.time() - self.started[0],
+                'cpu': time.clock() - self.started[1],
+            },
+            'phases': dict(
+                (phase, {'wall': self.wall[phase], 'cpu': self.cpu[phase]})
+                for phase in self.wall
+            ),
+            'counters': dict(self.counters),
+            'slowest_files': [
+                {'path': path, 'wall': seconds}
+                for path, seconds in self.slowest_files(slowest)
+            ],
+        }
+
+    def report(self, slowest=10):
+        """
+        Returns a table of the stats, for people.  With worker processes or
+        prefetching, phase times are summed over all processes and threads.
+        """
+        summary = self.to_json(slowest)
+        output = ['%-20s %10s %10s\n' % ('phase', 'wall', 'cpu')]
+        for phase in sorted(self.wall, key=self.wall.get, reverse=True):
+            output.append('%-20s %9.3fs %9.3fs\n' % (
+                phase, self.wall[phase], self.cpu[phase]
+            ))
+        output.append('%-20s %9.3fs %9.3fs\n\n' % (
+            '(elapsed)', summary['elapsed']['wall'], summary['elapsed']['cpu']
+        ))
+        for counter in self.COUNTERS:
+            output.append('%-20s %10d\n' % (counter, self.counters[counter]))
+        if summary['slowest_files']:
+            output.append('\nslowest files:\n')
+            for entry in summary['slowest_files']:
+                output.append('%9.3fs  %s\n' % (entry['wall'], entry['path']))
+        return ''.join(output)
+
+
+_stats = None
+
+
+def enable_stats():
+    """
+    Starts collecting Stats for everything modone does from now on (in this
+    process and any worker processes it starts), and returns them.  Until this
+    is called, nothing is collected.
+    """
+    global _stats
+    _stats = Stats()
+    return _stats
+
+
+def disable_stats():
+    """
+    Stops collecting Stats, and returns the ones collected, if any.
+    """
+    global _stats
+    stats, _stats = _stats, None
+    return stats
+
+
+def _timed(phase):
+    """
+    Decorates a function so that while stats are enabled, the time spent in
+    it is charged to `phase`.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kargs):
+            if _stats is None:
+                return function(*args, **kargs)
+            started = _stats.start()
+            try:
+                return function(*args, **kargs)
+            finally:
+                _stats.stop(phase, started)
+        return timed_function
+    return decorate
+
+
+def _print_stats(format):
+    if _stats is None:
+        return
+    if format == 'json':
+        json.dump(_stats.to_json(), sys.stderr, indent=2, sort_keys=True)
+        sys.stderr.write('\n')
+    else:
+        sys.stderr.write('\n' + _stats.report())
 
 
 def line_transformation_suggestor(line_transformation, line_filter=None):
@@ -77,14 +1355,20 @@ def line_transformation_suggestor(line_transformation, line_filter=None):
                                 returned the line itself for that line).
     """
     def suggestor(lines):
+        if _progress is not None:
+            lines = _watched_lines(lines, _progress)
         for line_number, line in enumerate(lines):
             if line_filter and not line_filter(line):
                 continue
             candidate = line_transformation(line)
             if candidate is None:
                 yield Patch(line_number)
-            else:
+            elif candidate != line:
+                # (Lines left as they are would only make patches that are
+                # dropped as no-ops.)
                 yield Patch(line_number, new_lines=[candidate])
+    suggestor.line_transformation = line_transformation
+    suggestor.line_filter = line_filter
     return suggestor
 
 
@@ -100,10 +1384,18 @@ def regex_suggestor(regex, substitution=None, ignore_case=False,
         line_transformation = lambda line: None if regex.search(line) else line
     else:
         line_transformation = lambda line: regex.sub(substitution, line)
-    return line_transformation_suggestor(line_transformation, line_filter)
+    suggestor = line_transformation_suggestor(line_transformation, line_filter)
+    # Let callers that only need to find matches (e.g. Query.count_matches)
+    # use the regex directly.
+    suggestor.regex = regex
+    suggestor.substitution = substitution
+    suggestor.multiline = False
+    suggestor.prefilter = regex_prefilter(regex)
+    return suggestor
 
 
-def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
+def multiline_regex_suggestor(regex, substitution=None, ignore_case=False,
+                              overlapping=True):
     """
     Return a suggestor function which, given a list of lines, generates patches
     to substitute matches of the given regex with (if provided) the given
@@ -114,6 +1406,31 @@ def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
                          without suggesting an alternative), or a string (using
                          \1 notation to backreference match groups) or a
                          function (that takes a match object as input).
+    @param overlapping   If true, a new search starts just after the start of
+                         each match, so matches that overlap it are suggested
+                         too (and reviewed one after another).  If false, it
+                         starts at the end of the match, in one pass over the
+                         text, and the matches are those re.sub would replace
+                         (see _sub_matches); this is much faster for patterns
+                         like '.*?' that span many lines.
+
+    Without overlapping, each engine makes the changes re.sub would (short of
+    adding a line after the last one):
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'a.txt')
+    >>> suggestor = multiline_regex_suggestor('(?m);?$', ';',
+    ...                                       overlapping=False)
+    >>> for engine in ('lines', 'mmap'):
+    ...     for text in ('a;\\nb\\n', 'a;\\nb'):
+    ...         with open(path, 'w') as file_w:
+    ...             file_w.write(text)
+    ...         applied = Query(suggestor, engine=engine).apply_patches(path)
+    ...         print engine, applied, repr(open(path).read())
+    lines (1, 0) 'a;\\nb;\\n'
+    lines (1, 0) 'a;\\nb;'
+    mmap (1, 0) 'a;\\nb;\\n'
+    mmap (1, 0) 'a;\\nb;'
     """
     if isinstance(regex, str):
         if ignore_case is False:
@@ -127,38 +1444,943 @@ def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
         substitution_func = substitution
 
     def suggestor(lines):
-        pos = 0
-        while True:
-            match = regex.search(''.join(lines), pos)
-            if not match:
-                break
-            start_row, start_col = _index_to_row_col(lines, match.start())
-            end_row, end_col = _index_to_row_col(lines, match.end() - 1)
+        return _span_patches(regex, substitution_func, _LineIndex(lines),
+                             overlapping)
 
-            if substitution is None:
-                new_lines = None
+    suggestor.regex = regex
+    suggestor.substitution = substitution
+    suggestor.multiline = True
+    suggestor.overlapping = overlapping
+    suggestor.prefilter = regex_prefilter(regex, multiline=True)
+    return suggestor
+
+
+def _span_patches(regex, substitution_func, index, overlapping=True):
+    """
+    Generates a SpanPatch for each match of `regex` in the text of a
+    _LineIndex, replacing it with substitution_func(match) (or just flagging
+    it, if substitution_func is None).  Matches that overlap others are
+    included if `overlapping` (see multiline_regex_suggestor).
+
+    >>> index = _LineIndex(['aaa\\n'])
+    >>> [(p.start, p.end) for p in _span_patches(re.compile('aa'), None,
+    ...                                          index)]
+    [(0, 2), (1, 3)]
+    >>> [(p.start, p.end) for p in _span_patches(re.compile('aa'), None,
+    ...                                          index, overlapping=False)]
+    [(0, 2)]
+    """
+    text = index.text
+    matches = _matches(regex, text, overlapping)
+    if _progress is not None:
+        matches = _watched_matches(matches, _progress)
+    for match in matches:
+        if _after_last_line(text, match.start()):
+            break
+
+        if substitution_func is None:
+            replacement = None
+        else:
+            replacement = substitution_func(match)
+
+        patch = SpanPatch(match.start(), match.end(), replacement)
+        patch.locate(index)
+        yield patch
+
+
+def _matches(regex, text, overlapping):
+    if not overlapping:
+        return _sub_matches(regex, text)
+    return _overlapping_matches(regex, text)
+
+
+def _sub_matches(regex, text):
+    r"""
+    Generates the matches of `regex` in `text` that regex.sub would replace:
+    those regex.finditer finds, less empty ones right after another match.
+    Those past the last line (see _after_last_line) are left for the caller
+    to skip, as they are in every engine.
+
+    >>> text = 'a;\nb'
+    >>> regex = re.compile('(?m);?$')
+    >>> [match.span() for match in _sub_matches(regex, text)]
+    [(1, 2), (4, 4)]
+    >>> regex.sub(';', text)
+    'a;\nb;'
+    """
+    previous_end = None
+    for match in regex.finditer(text):
+        start, end = match.span()
+        if start == end == previous_end:
+            continue
+        previous_end = end
+        yield match
+
+
+def _after_last_line(text, offset):
+    r"""
+    Returns whether `offset` is past the last line of `text`: at the end of
+    a text that is empty or ends with a newline, where no line is for a
+    match to be on.  (Where the last line has no newline, its end is still
+    on it.)
+
+    >>> _after_last_line('a\nb', 3), _after_last_line('a\n', 2)
+    (False, True)
+    """
+    return offset >= len(text) and text[-1:] in ('', '\n')
+
+
+def _overlapping_matches(regex, text):
+    pos = 0
+    while True:
+        match = regex.search(text, pos)
+        if not match:
+            return
+        yield match
+        pos = match.start() + 1
+
+
+def load_rules(stream, overlapping=True):
+    r"""
+    Reads rules from `stream`, which holds a JSON list of objects like
+
+        {"name": "rename-foo", "pattern": "foo\\(", "substitution": "bar(",
+         "ignore_case": false, "multiline": false}
+
+    of which only "pattern" is required.  Without a substitution, matches are
+    flagged for editing; the name defaults to the pattern.  Returns a
+    suggestor for each rule (see regex_suggestor and
+    multiline_regex_suggestor, which is passed `overlapping`) with its `name`
+    attribute set, ready for rules_suggestor.  Raises ValueError if the rules
+    can't be read.
+
+    >>> import StringIO
+    >>> rules = load_rules(StringIO.StringIO(
+    ...     '[{"pattern": "a+", "substitution": "b"},'
+    ...     ' {"name": "x", "pattern": "x.y", "multiline": true}]'))
+    >>> [(rule.name, rule.multiline) for rule in rules]
+    [('a+', False), ('x', True)]
+    """
+    try:
+        specs = json.load(stream)
+    except ValueError as e:
+        raise ValueError('rules are not valid JSON: %s' % e)
+    if not isinstance(specs, list):
+        raise ValueError('rules must be a JSON list of objects')
+
+    def string(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    rules = []
+    for number, spec in enumerate(specs, 1):
+        if not isinstance(spec, dict) or 'pattern' not in spec:
+            raise ValueError('rule %d has no "pattern"' % number)
+        if spec.get('multiline'):
+            make_suggestor = functools.partial(multiline_regex_suggestor,
+                                               overlapping=overlapping)
+        else:
+            make_suggestor = regex_suggestor
+        try:
+            rule = make_suggestor(string(spec['pattern']),
+                                  string(spec.get('substitution')),
+                                  bool(spec.get('ignore_case')))
+        except (re.error, TypeError) as e:
+            raise ValueError('rule %d: %s' % (number, e))
+        rule.name = string(spec.get('name')) or string(spec['pattern'])
+        rules.append(rule)
+    return rules
+
+
+def rules_suggestor(rules):
+    r"""
+    Returns a suggestor that checks every one of `rules`, which are suggestors
+    made by regex_suggestor and multiline_regex_suggestor (e.g. by
+    load_rules), in a single pass over each file.
+
+    A rule is only run over a file if the literal text that all its matches
+    must contain (see _analyze_pattern) is in it, and the literals of all the
+    rules are looked for together.  Per-line rules are run only over the
+    lines containing their literal.  Each match of a rule becomes a patch of
+    just the characters it matched, so that other rules can still change the
+    rest of the line.  Patches are generated in order of position
+    (by rule, for the same position) with the name of the rule that made them
+    in their `rule` attribute.
+
+    >>> rules = [regex_suggestor('foo', 'bar'), regex_suggestor('baz', 'qux'),
+    ...          multiline_regex_suggestor(r'x\ny', 'xy')]
+    >>> for rule, name in zip(rules, ['foo', 'baz', 'xy']):
+    ...     rule.name = name
+    >>> lines = ['foo(baz, foo)\n', 'x\n', 'y\n', 'baz\n']
+    >>> for patch in rules_suggestor(rules)(lines):
+    ...     print patch.rule, patch.replacement_lines(lines)
+    foo ['bar(baz, foo)\n']
+    baz ['foo(qux, foo)\n']
+    foo ['foo(baz, bar)\n']
+    xy ['xy\n']
+    baz ['qux\n']
+    """
+    rules = list(rules)
+    literals = [_analyze_pattern(rule.regex)[0] for rule in rules]
+    find_literals = _literal_finder(filter(None, literals))
+    # Rules that have to be run everywhere.
+    unfiltered = [rule for rule, literal in zip(rules, literals)
+                  if not literal]
+
+    def suggestor(lines):
+        index = _LineIndex(lines)
+        text = index.text
+        present = find_literals(text)
+        streams = []
+        for number, (rule, literal) in enumerate(zip(rules, literals)):
+            if literal and literal not in present:
+                continue
+            if rule.multiline:
+                substitution = rule.substitution
+                if isinstance(substitution, str):
+                    substitution_func = functools.partial(
+                        _expand, template=substitution
+                    )
+                else:
+                    substitution_func = substitution
+                patches = _span_patches(rule.regex, substitution_func, index,
+                                        rule.overlapping)
             else:
-                # TODO: ugh, this is hacky.  Clearly I need to rewrite
-                # this to use
-                # character-level patches, rather than line-level patches.
-                new_lines = substitution_func(match)
-                if new_lines is not None:
-                    new_lines = ''.join((
-                        lines[start_row][:start_col],
-                        new_lines,
-                        lines[end_row][end_col + 1:]
-                    ))
-
-            yield Patch(
-                start_line_number=start_row,
-                end_line_number=end_row + 1,
-                new_lines=new_lines
-            )
-            pos = match.start() + 1
+                patches = _line_rule_patches(rule, literal, lines, index)
+            streams.append(_tag_patches(patches, number, rule))
+        for _, _, patch in heapq.merge(*streams):
+            yield patch
+
+    def prefilter(text):
+        return bool(find_literals(text)) or any(
+            rule.prefilter(text) for rule in unfiltered
+        )
+
+    suggestor.rules = rules
+    suggestor.prefilter = prefilter
+    return suggestor
+
+
+def _expand(match, template):
+    return match.expand(template)
+
+
+def _tag_patches(patches, number, rule):
+    """
+    Generates (start, number, patch) for each of a rule's patches, for merging
+    by position, naming the rule in each patch.
+    """
+    name = getattr(rule, 'name', None) or rule.regex.pattern
+    for patch in patches:
+        patch.rule = name
+        yield patch.start, number, patch
+
+
+def _line_rule_patches(rule, literal, lines, index):
+    """
+    Generates a SpanPatch for each match of a per-line regex rule, replacing
+    just the characters it matched, as `regex.sub` would (or for the first
+    match on each line, if the rule only flags lines).
+    """
+    regex, substitution = rule.regex, rule.substitution
+    if isinstance(substitution, str):
+        substitution = _template_expander(regex, substitution)
+    line_filter = getattr(rule, 'line_filter', None)
+    if literal:
+        rows = _rows_containing(index, literal)
+    else:
+        rows = xrange(len(lines))
+    for row in rows:
+        line = lines[row]
+        if line_filter is not None and not line_filter(line):
+            continue
+        line_start = index.line_start(row)
+        if substitution is None:
+            match = regex.search(line)
+            if match is None:
+                continue
+            patch = SpanPatch(line_start + match.start(),
+                              line_start + match.end())
+            patch.locate(index)
+            yield patch
+            continue
+        for match in _sub_matches(regex, line):
+            start, end = match.span()
+            if _after_last_line(index.text, line_start + start):
+                break
+            replacement = substitution(match)
+            if replacement == match.group():
+                continue
+            patch = SpanPatch(line_start + start, line_start + end,
+                              replacement)
+            if start < len(line):
+                # (What locate would work out, without searching the index.)
+                patch.start_line_number = row
+                patch.end_line_number = row + 1
+                patch.start_col, patch.end_col = start, end
+            else:
+                patch.locate(index)
+            yield patch
+
+
+def _template_expander(regex, template):
+    r"""
+    Returns a function that does what match.expand(template) does for matches
+    of `regex`, parsing the template only once.
+
+    >>> regex = re.compile('(a)(b)')
+    >>> _template_expander(regex, r'\2\1')(regex.search('xab'))
+    'ba'
+    """
+    if '\\' not in template:
+        return lambda match: template
+    parsed = sre_parse.parse_template(template, regex)
+    return lambda match: sre_parse.expand_template(parsed, match)
+
+
+def _rows_containing(index, literal):
+    """
+    Generates, in order, the rows of a _LineIndex whose lines contain
+    `literal` (which has no newlines).
+    """
+    text = index.text
+    position = text.find(literal)
+    while position != -1:
+        row, _ = index.row_col(position)
+        yield row
+        # Move on to the next line.
+        position = text.find(literal, index.line_start(row + 1))
+
+
+def _literal_finder(literals, cache_size=64):
+    """
+    Returns a function that takes some text and returns the set of `literals`
+    that appear in it.
+
+    The literals are looked for with one regex, an alternation of all of
+    them, longest first.  A match hides any literal overlapping it, so the
+    search is repeated for the literals not found yet, until it finds none.
+
+    >>> find = _literal_finder(['foo', 'oob', 'bar', 'zzz'])
+    >>> sorted(find('a foobar'))
+    ['bar', 'foo', 'oob']
+    >>> find('nothing')
+    set([])
+    """
+    literals = frozenset(literals)
+    compiled = {}
 
+    def alternation(remaining):
+        try:
+            return compiled[remaining]
+        except KeyError:
+            if len(compiled) >= cache_size:
+                compiled.clear()
+            regex = compiled[remaining] = re.compile('|'.join(
+                re.escape(literal)
+                for literal in sorted(remaining, key=len, reverse=True)
+            ))
+            return regex
+
+    def find(text):
+        found = set()
+        remaining = literals
+        while remaining:
+            found_now = set(alternation(remaining).findall(text))
+            if not found_now:
+                break
+            found |= found_now
+            remaining = remaining - found_now
+        return found
+    return find
+
+
+def combine_suggestors(suggestors, overlaps='priority'):
+    r"""
+    Returns a suggestor that runs each of `suggestors` over the same lines
+    and generates all their patches, merged in order of position (and in the
+    order of `suggestors`, for the same position).  The patches of a
+    suggestor with a `name` attribute are given that name as their `rule`.
+    Each suggestor should generate its patches in order of position, as the
+    ones made by this module do.
+
+    Suggestors made by regex_suggestor are run as rules_suggestor runs
+    per-line rules, with a patch for each match, so that several of them can
+    change the same line.  Other per-line suggestors still suggest changes
+    to whole lines.
+
+    @param overlaps  What happens to patches that overlap: with 'priority',
+                     only the one from the suggestor that comes first in
+                     `suggestors` is kept; with 'first', the one that starts
+                     first (or, for the same start, comes first in
+                     `suggestors`); with 'keep', all of them are generated,
+                     and the ones overlapping a patch that is accepted are
+                     then dropped by Query.generate_buffer_patches.
+
+    >>> lines = ['foo x\n', 'y foo\n']
+    >>> upper = line_transformation_suggestor(
+    ...     lambda line: line.upper() if 'y' in line else line)
+    >>> rename = regex_suggestor('foo', 'bar')
+    >>> for patch in combine_suggestors([upper, rename])(lines):
+    ...     print patch.replacement_lines(lines)
+    ['bar x\n']
+    ['Y FOO\n']
+    >>> for patch in combine_suggestors([rename, upper])(lines):
+    ...     print patch.replacement_lines(lines)
+    ['bar x\n']
+    ['y bar\n']
+    >>> len(list(combine_suggestors([upper, rename], 'keep')(lines)))
+    3
+    >>> lines = ['foo(baz, foo)\n']
+    >>> query = Query([rename, regex_suggestor('baz', 'qux')])
+    >>> buffer = FileBuffer('x.js', lines[0], None)
+    >>> for patch in query.generate_buffer_patches(buffer):
+    ...     buffer.apply(patch)
+    >>> buffer.lines
+    ['bar(qux, bar)\n']
+    """
+    if overlaps not in ('priority', 'first', 'keep'):
+        raise ValueError('Unknown way to resolve overlaps: %r' % overlaps)
+    suggestors = list(suggestors)
+    # The literal each per-line regex suggestor's matches contain (see
+    # _line_rule_patches), or None for other suggestors.
+    literals = [
+        _analyze_pattern(part.regex)[0]
+        if getattr(part, 'regex', None) is not None and not part.multiline
+        else None
+        for part in suggestors
+    ]
+
+    def suggestor(lines):
+        index = None
+        streams = []
+        for number, (part, literal) in enumerate(zip(suggestors, literals)):
+            if literal is None:
+                patches = part(lines)
+            else:
+                if index is None:
+                    index = _LineIndex(lines)
+                patches = _line_rule_patches(part, literal, lines, index)
+            streams.append(_positioned_patches(patches, number, part, lines))
+        merged = heapq.merge(*streams)
+        if overlaps == 'keep':
+            return (item[-1] for item in merged)
+        return _resolve_overlaps(merged, by_priority=overlaps == 'priority')
+
+    prefilters = [getattr(part, 'prefilter', None) for part in suggestors]
+    if all(prefilters):
+        suggestor.prefilter = lambda text: any(
+            prefilter(text) for prefilter in prefilters
+        )
+    suggestor.suggestors = suggestors
+    suggestor.overlaps = overlaps
     return suggestor
 
 
+def _positioned_patches(patches, number, suggestor, lines):
+    """
+    Generates (start, number, sequence, end, patch) for each of a
+    suggestor's patches that would change something, for merging by
+    position; see _patch_extent.
+    """
+    name = getattr(suggestor, 'name', None)
+    for sequence, patch in enumerate(patches):
+        if patch.is_noop(lines):
+            continue
+        if name is not None and patch.rule is None:
+            patch.rule = name
+        start, end = _patch_extent(patch)
+        yield start, number, sequence, end, patch
+
+
+def _patch_extent(patch):
+    """
+    Returns the (line, column) positions where a patch starts and ends.
+    Patches that aren't SpanPatches cover whole lines.
+    """
+    if isinstance(patch, SpanPatch):
+        return ((patch.start_line_number, patch.start_col),
+                (patch.end_line_number - 1, patch.end_col))
+    return (patch.start_line_number, 0), (patch.end_line_number, 0)
+
+
+def _resolve_overlaps(items, by_priority):
+    """
+    Generates the patches of `items`, from _positioned_patches in order of
+    position, leaving out those that overlap others.  Of each group of
+    overlapping patches, they are kept in order of their suggestor's number
+    if `by_priority`, otherwise in order of position, as long as they don't
+    overlap one kept before.
+    """
+    group = []
+    group_end = None
+    for item in items:
+        if group and item[0] >= group_end:
+            for patch in _pick_from_overlapping(group, by_priority):
+                yield patch
+            group = []
+        if not group or item[3] > group_end:
+            group_end = item[3]
+        group.append(item)
+    for patch in _pick_from_overlapping(group, by_priority):
+        yield patch
+
+
+def _pick_from_overlapping(group, by_priority):
+    if len(group) == 1:
+        return [group[0][-1]]
+    candidates = group
+    if by_priority:
+        candidates = sorted(group, key=lambda item: item[1:3])
+    kept = []
+    for item in candidates:
+        if all(item[3] <= other[0] or other[3] <= item[0]
+               for other in kept):
+            kept.append(item)
+    kept.sort()
+    return [item[-1] for item in kept]
+
+
+def regex_prefilter(regex, multiline=False):
+    """
+    Returns a function that takes the contents of a file and returns False if
+    `regex` can't match anywhere in it: either because a literal string that
+    every match must contain doesn't appear in it, or because one search of
+    the whole contents found nothing.
+
+    @param multiline  If false, the regex is meant to be applied one line at a
+                      time.  The whole-contents search is then done in
+                      MULTILINE mode, and skipped for the (rare) patterns
+                      where that could miss a match that some line has.
+    """
+    literal, line_independent = _analyze_pattern(regex)
+    if multiline:
+        search = regex.search
+    elif line_independent:
+        search = re.compile(regex.pattern, regex.flags | re.MULTILINE).search
+    else:
+        search = None
+
+    def prefilter(text):
+        if literal and literal not in text:
+            return False
+        if search is None:
+            return True
+        if _progress is not None:
+            # In a watched worker (see _watched_map_paths), a search that
+            # runs over budget should be caught where it can tell which
+            # lines it was on.
+            if not multiline:
+                return True
+            _progress[0], _progress[1] = _OFFSET_PROGRESS, 0
+        return search(text) is not None
+    return prefilter
+
+
+# Anchors that behave the same at the start of a line as at the start of the
+# string, given re.MULTILINE.
+_LINE_ANCHORS = frozenset([sre_constants.AT_BEGINNING,
+                           sre_constants.AT_BEGINNING_LINE])
+# Categories of characters that don't include newlines.
+_NEWLINE_FREE_CATEGORIES = frozenset([
+    sre_constants.CATEGORY_DIGIT, sre_constants.CATEGORY_NOT_SPACE,
+    sre_constants.CATEGORY_WORD, sre_constants.CATEGORY_NOT_LINEBREAK,
+])
+
+
+def _analyze_pattern(regex):
+    r"""
+    Returns the longest literal string that every match of `regex` contains
+    (or '' if there isn't one we can be sure of), and whether searching a
+    whole file with the regex in MULTILINE mode finds a match whenever
+    searching one of its lines does.
+
+    >>> _analyze_pattern(re.compile(r'foo\(\w+, bar'))
+    (', bar', True)
+    >>> _analyze_pattern(re.compile(r'(?:abc)+|x'))
+    ('', True)
+    >>> _analyze_pattern(re.compile(r'^(x*)(abc)+'))
+    ('abc', True)
+    >>> _analyze_pattern(re.compile(r'foo', re.IGNORECASE))
+    ('', True)
+    >>> _analyze_pattern(re.compile(r'foo\s*\Z'))
+    ('foo', False)
+    >>> _analyze_pattern(re.compile(r'foo\n$'))
+    ('foo\n', False)
+    """
+    if not isinstance(regex.pattern, str):
+        return '', False
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (sre_constants.error, RuntimeError):
+        return '', False
+    flags = parsed.pattern.flags
+
+    state = {'anchors': False, 'newline': False, 'unsafe': False}
+
+    def matches_newline(op, av):
+        if op == sre_constants.LITERAL:
+            return av == 10
+        if op == sre_constants.NOT_LITERAL:
+            return av != 10
+        if op == sre_constants.ANY:
+            return bool(flags & re.DOTALL)
+        if op == sre_constants.RANGE:
+            return av[0] <= 10 <= av[1]
+        if op == sre_constants.CATEGORY:
+            return av not in _NEWLINE_FREE_CATEGORIES
+        if op == sre_constants.NEGATE:
+            return True
+        return False
+
+    def longest_literal(subpattern):
+        best = ''
+        run = []
+        for op, av in subpattern:
+            candidate = ''
+            if op == sre_constants.LITERAL:
+                state['newline'] |= av == 10
+                run.append(chr(av))
+                continue
+            if op == sre_constants.SUBPATTERN:
+                candidate = longest_literal(av[1])
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                candidate = longest_literal(av[2])
+                if av[0] < 1:
+                    candidate = ''
+            elif op == sre_constants.BRANCH:
+                for branch in av[1]:
+                    longest_literal(branch)
+            elif op == sre_constants.GROUPREF_EXISTS:
+                for branch in av[1:]:
+                    if branch is not None:
+                        longest_literal(branch)
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                longest_literal(av[1])
+                if op == sre_constants.ASSERT_NOT or av[0] < 0:
+                    state['unsafe'] = True
+            elif op == sre_constants.AT:
+                if av not in _LINE_ANCHORS:
+                    state['anchors'] = True
+                # \B can match at the very end of a line, after its
+                # newline, where the next line's first character would make
+                # it fail.
+                if av in (sre_constants.AT_BEGINNING_STRING,
+                          sre_constants.AT_END_STRING,
+                          sre_constants.AT_NON_BOUNDARY):
+                    state['unsafe'] = True
+            elif op == sre_constants.IN:
+                state['newline'] |= any(matches_newline(*item) for item in av)
+            else:
+                state['newline'] |= matches_newline(op, av)
+            best = max(best, ''.join(run), candidate, key=len)
+            run = []
+        return max(best, ''.join(run), key=len)
+
+    literal = longest_literal(parsed)
+    if flags & re.IGNORECASE:
+        literal = ''
+    # A match confined to one line only depends on the text around it through
+    # anchors and lookarounds, and those only see past the end of the line if
+    # the match swallowed its newline.
+    line_independent = not (
+        state['unsafe'] or (state['anchors'] and state['newline'])
+    )
+    return literal, line_independent
+
+
+class _LineIndex(object):
+    r"""
+    The concatenation of a list of lines, along with the offset at which each
+    line starts so that offsets into the text can be mapped back to (row,
+    column) pairs by bisection.
+
+    >>> index = _LineIndex(['hello\n', 'world\n'])
+    >>> index.row_col(0), index.row_col(7)
+    ((0, 0), (1, 1))
+    >>> index.row_col(12)
+    Traceback (most recent call last):
+    ...
+    IndexError: index 12 out of range
+
+    The end of a last line without a newline is on that line:
+
+    >>> _LineIndex(['a\n', 'bc']).row_col(4)
+    (1, 2)
+    """
+
+    def __init__(self, lines):
+        self.text = ''.join(lines)
+        starts = []
+        offset = 0
+        for line in lines:
+            starts.append(offset)
+            offset += len(line)
+        starts.append(offset)
+        self._starts = starts
+
+    def line_start(self, row):
+        """Returns the offset at which line `row` starts."""
+        return self._starts[row]
+
+    def row_col(self, index):
+        if not 0 <= index < len(self.text) and (
+                _after_last_line(self.text, index) or index != len(self.text)):
+            raise IndexError('index %d out of range' % index)
+        # (Not counting the offset just past the last line.)
+        row = bisect.bisect_right(self._starts, index, 0,
+                                  len(self._starts) - 1) - 1
+        return row, index - self._starts[row]
+
+
+def _split_lines(text):
+    r"""
+    Splits `text` into lines the way iterating over a file does, i.e. only
+    after newlines.
+
+    >>> _split_lines('a\r\nb\x0cc\nd')
+    ['a\r\n', 'b\x0cc\n', 'd']
+    >>> _split_lines('a\n')
+    ['a\n']
+    """
+    lines = [line + '\n' for line in text.split('\n')]
+    last = lines.pop()
+    if last != '\n':
+        lines.append(last[:-1])
+    return lines
+
+
+def read_paths(stream, delimiter='\n', chunk_size=65536):
+    r"""
+    Lazily yields the `delimiter`-separated paths read from `stream`, skipping
+    empty entries.  Data is read as soon as it is available, so the first path
+    can be processed while the producer (e.g. `find` or `grep -l`) is still
+    running.
+
+    >>> from StringIO import StringIO
+    >>> list(read_paths(StringIO('a.py\nb c.py\n\n')))
+    ['a.py', 'b c.py']
+    >>> list(read_paths(StringIO('a\0b\nc\0'), delimiter='\0', chunk_size=2))
+    ['a', 'b\nc']
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, IOError, ValueError):
+        fd = None
+
+    def read_chunk():
+        if fd is not None:
+            # os.read returns whatever is available instead of blocking until
+            # the whole chunk has been filled, as file.read would.
+            return os.read(fd, chunk_size)
+        return stream.read(chunk_size)
+
+    pending = ''
+    while True:
+        chunk = read_chunk()
+        if not chunk:
+            break
+        pending += chunk
+        entries = pending.split(delimiter)
+        pending = entries.pop()
+        for entry in entries:
+            if entry:
+                yield entry
+    if pending:
+        yield pending
+
+
+def walk_tree(roots, include=(), exclude=(), gitignore=True):
+    """
+    Lazily yields the paths of the files under each of `roots` (directories,
+    or files, which are yielded as they are), in sorted order.  `.git`
+    directories are skipped.
+
+    @param include    Globs; if any are given, only files whose name or path
+                      relative to the root matches one of them are yielded.
+    @param exclude    Globs; files and directories whose name or relative
+                      path matches one of them are skipped.
+    @param gitignore  If true, files and directories ignored by the
+                      `.gitignore` files found on the way are skipped.
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> for path, text in [('.gitignore', '*.log\\n!keep.log\\nbuild/\\n'),
+    ...                    ('a.log', ''), ('keep.log', ''),
+    ...                    ('build/a.txt', ''), ('.git/config', ''),
+    ...                    ('src/.gitignore', '!debug.log\\n'),
+    ...                    ('src/build', ''), ('src/debug.log', ''),
+    ...                    ('src/other.log', '')]:
+    ...     path = os.path.join(root, path)
+    ...     if not os.path.isdir(os.path.dirname(path)):
+    ...         os.makedirs(os.path.dirname(path))
+    ...     with open(path, 'w') as file_w:
+    ...         file_w.write(text)
+    >>> for path in walk_tree([root]):
+    ...     print os.path.relpath(path, root)
+    .gitignore
+    keep.log
+    src/.gitignore
+    src/build
+    src/debug.log
+    """
+    def matches(globs, name, relative_path):
+        return any(fnmatch.fnmatch(name, glob) or
+                   fnmatch.fnmatch(relative_path, glob) for glob in globs)
+
+    for root in roots:
+        if not os.path.isdir(root):
+            yield root
+            continue
+        # (directory, path relative to root, ignore rules that apply to it)
+        pending = [(root, '', [])]
+        while pending:
+            directory, relative_directory, rules = pending.pop()
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            if gitignore and '.gitignore' in names:
+                try:
+                    with open(os.path.join(directory, '.gitignore')) as f:
+                        rules = rules + [_GitIgnore(f, relative_directory)]
+                except IOError:
+                    pass
+            subdirectories = []
+            for name in names:
+                path = os.path.join(directory, name)
+                relative_path = relative_directory + name
+                is_directory = os.path.isdir(path) and not os.path.islink(path)
+                if is_directory and name == '.git':
+                    continue
+                if matches(exclude, name, relative_path):
+                    continue
+                if _is_ignored(rules, relative_path, is_directory):
+                    continue
+                if is_directory:
+                    subdirectories.append((path, relative_path + '/', rules))
+                elif not include or matches(include, name, relative_path):
+                    yield path
+            pending.extend(reversed(subdirectories))
+
+
+def _is_ignored(rules, relative_path, is_directory):
+    # Later (deeper) .gitignore files take precedence.
+    for ignore in reversed(rules):
+        ignored = ignore.match(relative_path, is_directory)
+        if ignored is not None:
+            return ignored
+    return False
+
+
+class _GitIgnore(object):
+    r"""
+    The patterns in a .gitignore file, found in the directory at `base` (a
+    path relative to the root being walked, ending in '/' unless it's '').
+
+    >>> from StringIO import StringIO
+    >>> ignore = _GitIgnore(StringIO('*.pyc\n/build/\ndocs/**/*.txt\n'
+    ...                              '!keep.pyc\n# comment\n'), 'src/')
+    >>> ignore.match('src/a/b.pyc', False)
+    True
+    >>> ignore.match('src/keep.pyc', False)
+    False
+    >>> ignore.match('src/build', True), ignore.match('src/a/build', True)
+    (True, None)
+    >>> ignore.match('src/build', False)
+    >>> ignore.match('src/docs/x/y/z.txt', False)
+    True
+    >>> ignore.match('lib/a.pyc', False)
+    """
+
+    def __init__(self, lines, base=''):
+        self.base = base
+        # (regex, negated, directories only), in order.
+        self.patterns = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip('\r')
+            if line.endswith('\\ '):
+                line = line[:-2].rstrip(' ') + '\\ '
+            else:
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            directories_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            # A pattern with a slash in it (other than at the end) is relative
+            # to the .gitignore's directory; otherwise it matches a name at
+            # any depth.
+            anchored = '/' in line
+            line = line.lstrip('/')
+            regex = _gitignore_glob_to_regex(line)
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            self.patterns.append(
+                (re.compile(regex + r'\Z', re.DOTALL), negated,
+                 directories_only)
+            )
+
+    def match(self, relative_path, is_directory):
+        """
+        Returns True if the last pattern matching `relative_path` ignores it,
+        False if it re-includes it, and None if no pattern matches.
+        """
+        if not relative_path.startswith(self.base):
+            return None
+        path = relative_path[len(self.base):]
+        for regex, negated, directories_only in reversed(self.patterns):
+            if directories_only and not is_directory:
+                continue
+            if regex.match(path):
+                return not negated
+        return None
+
+
+def _gitignore_glob_to_regex(glob):
+    r"""
+    >>> _gitignore_glob_to_regex('a/**/b*.c?')
+    'a/(?:.*/)?b[^/]*\\.c[^/]'
+    """
+    parts = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif glob.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif glob[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif glob[i] == '[' and ']' in glob[i + 2:]:
+            end = glob.index(']', i + 2)
+            body = glob[i + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append('[%s]' % body.replace('\\', '\\\\'))
+            i = end + 1
+        elif glob[i] == '\\' and i + 1 < len(glob):
+            parts.append(re.escape(glob[i + 1]))
+            i += 2
+        elif glob[i] == '/':
+            parts.append('/')
+            i += 1
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return ''.join(parts)
+
+
 def _index_to_row_col(lines, index):
     r"""
     >>> lines = ['hello\n', 'world\n']
@@ -167,64 +2389,1906 @@ def _index_to_row_col(lines, index):
     >>> _index_to_row_col(lines, 7)
     (1, 1)
     """
-    if index < 0:
-        raise IndexError('negative index')
-    current_index = 0
-    for line_number, line in enumerate(lines):
-        line_length = len(line)
-        if current_index + line_length > index:
-            return line_number, index - current_index
-        current_index += line_length
-    raise IndexError('index %d out of range' % index)
+    if index < 0:
+        raise IndexError('negative index')
+    current_index = 0
+    for line_number, line in enumerate(lines):
+        line_length = len(line)
+        if current_index + line_length > index:
+            return line_number, index - current_index
+        current_index += line_length
+    raise IndexError('index %d out of range' % index)
+
+
+class Query(object):
+    """
+    Represents a suggestor, along with a set of constraints on which files
+    should be fed to that suggestor.
+
+    """
+
+    def __init__(self, suggestor, path=None, paths=None, prefilter=None,
+                 engine='lines', prefetch=0, cache=None, jobs=1,
+                 buffers=None, file_budget=None, match_budget=None):
+
+        """
+        @param suggestor            A function that takes a list of lines and
+                                    generates instances of Patch to suggest.
+                                    (Patches should not specify paths.)  Or
+                                    a list of them, to be run together in a
+                                    single pass over each file (see
+                                    combine_suggestors).
+        @param path                 A single path to run the suggestor over.
+        @param paths                An iterable of paths.  It is consumed
+                                    lazily, so it may be a generator reading
+                                    paths from a pipe (see `read_paths`).
+        @param prefilter            A function that takes the contents of a
+                                    file and returns False if the suggestor
+                                    can't possibly suggest anything for it,
+                                    in which case the file is skipped without
+                                    being split into lines.  Defaults to the
+                                    suggestor's `prefilter` attribute, which
+                                    the regex suggestors set.
+        @param engine               How count_matches and apply_patches look
+                                    at files.  'lines' reads each file into a
+                                    list of lines; 'mmap' memory-maps it and
+                                    runs the regex directly over the mapping,
+                                    which keeps memory use close to the size
+                                    of the file (see mmap_matches); 'stream'
+                                    (for per-line suggestors only) reads and
+                                    writes it a line at a time, which keeps
+                                    memory use constant (see
+                                    stream_apply_patches), and is used by
+                                    export_patches as well.  Patches for
+                                    review are always generated from lines.
+        @param prefetch             If positive, generate_patches reads files
+                                    and runs the suggestor over them in a
+                                    background thread, up to this many files
+                                    with patches ahead of the one being
+                                    reviewed (see _Prefetcher).
+        @param cache                A ScanCache.  Files it knows the query
+                                    has nothing to suggest for are skipped,
+                                    and patches the user rejected before
+                                    aren't suggested again.  Only used
+                                    if the suggestor is one whose query_key
+                                    is known.
+        @param jobs                 If more than 1, generate_patches reads
+                                    files and runs the suggestor over them in
+                                    this many worker processes, which send
+                                    back only the files with patches, along
+                                    with the patches (see scan_buffers).
+                                    Takes the place of `prefetch`.
+        @param buffers              A _LRU in which to keep the FileBuffers
+                                    read, by path, so that later queries
+                                    (e.g. from serve) needn't read files that
+                                    haven't changed since.
+        @param file_budget          If given, the most seconds the sweeps
+                                    (run_headless, run_count, run_export, and
+                                    generate_patches with `jobs`) may spend
+                                    on a file.  They then look at files in
+                                    worker processes, and one that runs over
+                                    is killed; the file is skipped and
+                                    reported (see TimeBudgetExceeded).
+        @param match_budget         Likewise, the most seconds that may be
+                                    spent on one line, or on one search of
+                                    the whole text by a multiline suggestor
+                                    (e.g. a regex that backtracks
+                                    catastrophically).
+
+        """
+        if engine not in ('lines', 'mmap', 'stream'):
+            raise ValueError('Unknown engine %r' % engine)
+        if isinstance(suggestor, (list, tuple)):
+            suggestor = combine_suggestors(suggestor)
+        self.suggestor = suggestor
+        self.path = path
+        self.paths = paths
+        if prefilter is None:
+            prefilter = getattr(suggestor, 'prefilter', None)
+        self.prefilter = prefilter
+        self.engine = engine
+        self.prefetch = prefetch
+        self.jobs = jobs
+        self.buffers = buffers
+        self.file_budget = file_budget
+        self.match_budget = match_budget
+        self.cache = cache
+        self.cache_key = None
+        if cache is not None:
+            self.cache_key = query_key(suggestor)
+
+    def iter_paths(self):
+        """
+        Yields `path` (if given) followed by each of `paths`.
+        """
+        if self.path is not None:
+            yield self.path
+        if self.paths is not None:
+            for path in self.paths:
+                yield path
+
+    def in_workers(self, jobs=1):
+        """
+        Returns whether map_paths calls its function in worker processes.
+        """
+        return (jobs > 1 or self.file_budget is not None or
+                self.match_budget is not None)
+
+    def map_paths(self, function, jobs=1):
+        """
+        Generates (path, function(path)) for each of our paths, in order, in
+        `jobs` worker processes (see _map_paths), and within our time
+        budgets, if any.
+        """
+        if self.file_budget is None and self.match_budget is None:
+            return _map_paths(function, self.iter_paths(), jobs)
+        return _watched_map_paths(function, self.iter_paths(), jobs,
+                                  self.file_budget, self.match_budget)
+
+    def generate_patches(self):
+        """
+        Generates a list of patches for each file
+        that satisfy the given conditions given
+        query conditions, where patches for
+        each file are suggested by self.suggestor.
+        """
+        if self.jobs > 1 or self.prefetch > 0:
+            if self.jobs > 1:
+                prepared = self.scan_buffers(self.jobs)
+            else:
+                prepared = _Prefetcher(self, self.prefetch)
+            try:
+                for buffer, suggestions in prepared:
+                    if buffer.refresh():
+                        # The file changed after it was prepared.
+                        suggestions = None
+                    for patch in self._review_buffer_patches(buffer,
+                                                             suggestions):
+                        yield patch
+            finally:
+                prepared.close()
+            return
+
+        for buffer in self.open_buffers():
+            for patch in self._review_buffer_patches(buffer):
+                yield patch
+
+    def _review_buffer_patches(self, buffer, suggestions=None):
+        """
+        Generates the patches for a FileBuffer that are to be shown to the
+        user, leaving out those the cache says were rejected before.
+        """
+        if self.cache_key is None:
+            for patch in self.generate_buffer_patches(buffer, suggestions):
+                yield patch
+            return
+        # How many times each fingerprint has come up, to tell apart patches
+        # that look the same.
+        seen = {}
+        for patch in self.generate_buffer_patches(buffer, suggestions):
+            fingerprint = _patch_fingerprint(patch)
+            seen[fingerprint] = occurrence = seen.get(fingerprint, 0) + 1
+            patch.fingerprint = '%s#%d' % (fingerprint, occurrence)
+            if self.cache.is_rejected(self.cache_key, buffer.path,
+                                      patch.fingerprint):
+                continue
+            yield patch
+        if not seen:
+            # (A file with only rejected patches still has matches, as far
+            # as counting or --accept-all are concerned.)
+            self.note_clean(buffer.path, buffer.signature)
+
+    def note_clean(self, path, signature=None):
+        """
+        Tells the cache, if any, that the query has nothing to suggest for the
+        file at `path`, as of the given signature (see _read_file; by default,
+        the file's current one).
+        """
+        if self.cache_key is not None:
+            self.cache.mark_clean(self.cache_key, path, signature)
+
+    def note_rejected(self, patch):
+        """
+        Tells the cache, if any, that the user rejected `patch` (as generated
+        by generate_patches), so that it isn't suggested again.
+        """
+        fingerprint = patch.fingerprint
+        if self.cache_key is not None and fingerprint is not None:
+            self.cache.reject(self.cache_key, patch.path, fingerprint)
+
+    def _known_clean(self, path):
+        if self.cache_key is not None and self.cache.is_clean(self.cache_key,
+                                                              path):
+            if _stats is not None:
+                _stats.count('files_cached')
+            return True
+        return False
+
+    def open_buffers(self):
+        """
+        Generates a FileBuffer for each path that can be read and isn't ruled
+        out by self.prefilter.
+        """
+        for path in self.iter_paths():
+            try:
+                buffer = self.open_buffer(path)
+            except IOError:
+                # If we can't open the file--perhaps it's a symlink whose
+                # destination no loner exists--then short-circuit.
+                continue
+            if buffer is not None:
+                yield buffer
+
+    def scan_buffers(self, jobs):
+        """
+        Like open_buffers, but generates (buffer, patches) for only the files
+        with patches to suggest, as from `suggest`.  The files are read and
+        searched by a pool of `jobs` worker processes, so only files with
+        patches are sent back; whoever uses a buffer should `refresh` it.
+        """
+        for path, result in self.map_paths(self._scan_file, jobs):
+            if isinstance(result, TimeBudgetExceeded):
+                sys.stderr.write('%s: %s\n' % (path, result))
+                continue
+            if result is None or isinstance(result, EnvironmentError):
+                continue
+            text, signature, patches = result
+            if patches is None:
+                # The worker's copy of the cache isn't saved.
+                self.note_clean(path, signature)
+                continue
+            yield FileBuffer(path, text, signature), patches
+
+    def _scan_file(self, path):
+        # The worker half of scan_buffers.  Returns (text, signature,
+        # patches), with text and patches None if there are none.
+        if self._known_clean(path):
+            return None
+        text, signature = _read_file(path)
+        if self.prefilter is not None and not self._prefilter(text):
+            if _stats is not None:
+                _stats.count('files_prefiltered')
+            return None, signature, None
+        patches = self.suggest(_split_lines(text))
+        if not patches:
+            return None, signature, None
+        return text, signature, patches
+
+    def suggest(self, lines):
+        """
+        Returns the patches self.suggestor suggests for `lines`, leaving out
+        the ones that wouldn't change anything.  They are kept in a PatchSet,
+        unless the suggestor makes patches a PatchSet can't hold.
+        """
+        suggestions = self.suggestor(lines)
+        if _stats is not None:
+            suggestions = _stats.timed('match', suggestions)
+        patches = PatchSet()
+        for patch in suggestions:
+            if patch.is_noop(lines):
+                continue
+            if isinstance(patches, PatchSet):
+                if patches.holds(patch):
+                    try:
+                        patches.append(patch)
+                        continue
+                    except OverflowError:
+                        pass
+                patches = list(patches)
+            patches.append(patch)
+        return patches
+
+    def open_buffer(self, path):
+        """
+        Reads the file at `path` into a FileBuffer, or returns None if
+        self.prefilter rules it out.  Raises IOError if the file can't be
+        read.
+        """
+        if self._known_clean(path):
+            return None
+        if self.buffers is not None:
+            buffer = self.buffers.get(os.path.abspath(path))
+            # (Buffers with patches applied but not saved, as by
+            # export_patches, don't hold what's on disk.  Patches take their
+            # path from the buffer, so it has to be the one asked for.)
+            if (buffer is not None and not buffer.dirty and
+                    buffer.path == path and
+                    buffer.signature == _path_signature(path)):
+                if _stats is not None:
+                    _stats.count('reads_saved')
+                return buffer
+        text, signature = _read_file(path)
+        if self.prefilter is not None and not self._prefilter(text):
+            if _stats is not None:
+                _stats.count('files_prefiltered')
+            self.note_clean(path, signature)
+            return None
+        buffer = FileBuffer(path, text, signature)
+        if self.buffers is not None:
+            self.buffers[os.path.abspath(path)] = buffer
+        return buffer
+
+    @_timed('prefilter')
+    def _prefilter(self, text):
+        return self.prefilter(text)
+
+    def generate_buffer_patches(self, buffer, suggestions=None):
+        """
+        Generates the patches self.suggestor suggests for a FileBuffer.
+        `suggestions`, if given, are the patches it already suggested for the
+        buffer's current lines (see `suggest`).
+
+        The suggestor makes a single pass over a snapshot of the buffer.  As
+        patches are applied to the buffer, the ones that come after them are
+        rebased onto its current contents (see _EditTracker), and those that
+        overlap an applied patch are dropped.  The suggestor is only run again
+        if the file is changed behind our back (e.g. in the editor), in which
+        case it picks up from the line after the last patch.
+        """
+        resume_line = 0
+        while True:
+            snapshot = list(buffer.lines)
+            edits = _EditTracker(buffer, snapshot)
+            changed = False
+            if suggestions is None:
+                suggestions = self.suggestor(snapshot)
+                if _stats is not None:
+                    suggestions = _stats.timed('match', suggestions)
+            for patch in suggestions:
+                if patch.start_line_number < resume_line:
+                    continue
+                if patch.is_noop(snapshot):
+                    continue
+                original = edits.rebase(patch)
+                if original is None:
+                    continue
+                patch.path = buffer.path
+                patch.buffer = buffer
+                if _stats is not None:
+                    _stats.count('patches_suggested')
+                yield patch
+                if patch.applied:
+                    edits.record(patch, original)
+                if buffer.refresh():
+                    resume_line = patch.start_line_number + 1
+                    changed = True
+                    break
+            if not changed:
+                return
+            suggestions = None
+
+    def apply_patches(self, path, fsync=False):
+        """
+        Applies every change suggested for the file at `path`, saving it once
+        (atomically) at the end.  Returns the number of patches applied and
+        the number of matches that were only flagged (had no suggested
+        change), or None if the file couldn't be read.
+        """
+        if self.engine != 'lines':
+            if self._known_clean(path):
+                return 0, 0
+            apply_patches = (mmap_apply_patches if self.engine == 'mmap'
+                             else stream_apply_patches)
+            try:
+                result = apply_patches(path, self.suggestor, fsync)
+            except EnvironmentError:
+                return None
+            if result == (0, 0):
+                self.note_clean(path)
+            return result
+
+        try:
+            buffer = self.open_buffer(path)
+        except IOError:
+            return None
+        if buffer is None:
+            return 0, 0
+        changes, flagged = self._changes(buffer)
+        if changes:
+            buffer.replace_ranges(changes)
+            buffer.flush(fsync)
+        if not changes and not flagged:
+            self.note_clean(path, buffer.signature)
+        return len(changes), flagged
+
+    def _changes(self, buffer):
+        """
+        Returns the changes suggested for a FileBuffer, as (start, end,
+        replacement) ranges of its text for FileBuffer.replace_ranges, and the
+        number of matches only flagged.  As with generate_buffer_patches,
+        patches that overlap one accepted before them are left out.
+        """
+        lines = buffer.lines
+        index = buffer.index
+        edits = OffsetMap()
+        changes = []
+        flagged = 0
+        suggestions = self.suggestor(lines)
+        if _stats is not None:
+            suggestions = _stats.timed('match', suggestions)
+        for patch in suggestions:
+            if patch.is_noop(lines):
+                continue
+            if isinstance(patch, SpanPatch):
+                start, end = patch.start, patch.end
+                replacement = patch.replacement
+            else:
+                start = index.line_start(patch.start_line_number)
+                end = index.line_start(patch.end_line_number)
+                replacement = (''.join(patch.new_lines)
+                               if patch.suggests_change else None)
+            if edits.rebase(start, end) is None:
+                continue
+            if _stats is not None:
+                _stats.count('patches_suggested')
+            if replacement is None:
+                flagged += 1
+            else:
+                edits.record(start, end, len(replacement))
+                changes.append((start, end, replacement))
+        changes.sort()
+        return changes, flagged
+
+    def export_patches(self, path, format='jsonl', context=3):
+        """
+        Returns the patches suggested for the file at `path` as text in the
+        given format (see run_export), along with how many there are, or None
+        if the file couldn't be read.
+        """
+        if self.engine == 'stream':
+            if self._known_clean(path):
+                return '', 0
+            try:
+                return stream_export_patches(path, self.suggestor, format,
+                                             context)
+            except EnvironmentError:
+                return None
+
+        try:
+            buffer = self.open_buffer(path)
+        except IOError:
+            return None
+        if buffer is None:
+            return '', 0
+        original = list(buffer.lines)
+        records = []
+        changes = _ChangedRegions()
+        for patch in self.generate_buffer_patches(buffer):
+            if format == 'quickfix':
+                records.append(quickfix_line(patch, original))
+            elif format == 'jsonl':
+                # Nothing is applied, so the patch is still where it was
+                # suggested.
+                record = {
+                    'path': path,
+                    'start': patch.start_line_number,
+                    'end': patch.end_line_number,
+                    'old_lines': original[
+                        patch.start_line_number:patch.end_line_number],
+                    'new_lines': patch.new_lines,
+                }
+                if isinstance(patch, SpanPatch):
+                    record['span'] = [patch.start, patch.end]
+                    record['replacement'] = patch.replacement
+                if patch.rule is not None:
+                    record['rule'] = patch.rule
+                records.append(record)
+            elif patch.suggests_change:
+                start, end = patch.start_line_number, patch.end_line_number
+                new_lines = patch.replacement_lines(buffer.lines)
+                buffer.apply(patch)
+                changes.add(start, end, len(new_lines))
+
+        if format == 'quickfix':
+            return ''.join(records), len(records)
+        if format == 'jsonl':
+            content_hash = _content_hash(original)
+            for record in records:
+                record['hash'] = content_hash
+            return ''.join(map(_encode_message, records)), len(records)
+        return (_unified_diff(path, original, buffer.lines, changes, context),
+                changes.count)
+
+    def count_matches(self, path):
+        """
+        Returns the number of places in the file at `path` where the query
+        matches, or None if the file couldn't be read.
+
+        For suggestors made by regex_suggestor and multiline_regex_suggestor,
+        the regex is run over the file contents directly (over the whole file
+        for the latter, one line at a time for the former) and no patches are
+        constructed.  Note that the multiline count is of non-overlapping
+        matches.  For any other suggestor, the patches it suggests are
+        counted.
+        """
+        if self._known_clean(path):
+            return 0
+        if self.engine != 'lines':
+            count_matches = (mmap_count_matches if self.engine == 'mmap'
+                             else stream_count_matches)
+            try:
+                count = count_matches(path, self.suggestor)
+            except EnvironmentError:
+                return None
+            if count == 0:
+                self.note_clean(path)
+            return count
+
+        try:
+            text, signature = _read_file(path)
+        except IOError:
+            return None
+        if self.prefilter is not None and not self._prefilter(text):
+            if _stats is not None:
+                _stats.count('files_prefiltered')
+            count = 0
+        else:
+            count = self._count_text_matches(path, text, signature)
+        if count == 0:
+            self.note_clean(path, signature)
+        return count
+
+    @_timed('match')
+    def _count_text_matches(self, path, text, signature):
+        regex = getattr(self.suggestor, 'regex', None)
+        if regex is None:
+            buffer = FileBuffer(path, text, signature)
+            return sum(1 for _ in self.generate_buffer_patches(buffer))
+        if self.suggestor.multiline:
+            matches = _sub_matches(regex, text)
+            if _progress is not None:
+                matches = _watched_matches(matches, _progress)
+            return sum(1 for match in matches
+                       if not _after_last_line(text, match.start()))
+        search = regex.search
+        line_filter = self.suggestor.line_filter
+        lines = _split_lines(text)
+        if _progress is not None:
+            lines = _watched_lines(lines, _progress)
+        return sum(
+            1 for line in lines
+            if (line_filter is None or line_filter(line)) and search(line)
+        )
+
+    def run_interactive(self, **kargs):
+        run_interactive(self, **kargs)
+
+    def run_count(self, **kargs):
+        return run_count(self, **kargs)
+
+    def run_headless(self, **kargs):
+        return run_headless(self, **kargs)
+
+
+class _Prefetcher(object):
+    """
+    Reads the files of a Query and runs its suggestor over them in a
+    background thread, up to `depth` files (with patches) ahead of the one
+    being reviewed.  Most of its work gets done while the user is thinking:
+    the main thread releases the GIL while it waits for input.
+
+    Iterating over it generates (buffer, patches) for each file with patches
+    to suggest, as from Query.suggest.  A buffer may have changed on disk
+    after it was read; whoever uses it should `refresh` it.
+
+    Once `close` returns, the thread reads no more files and leaves the
+    query's cache alone.
+    """
+
+    def __init__(self, query, depth):
+        import Queue
+        import threading
+
+        self.query = query
+        self.queue = Queue.Queue(depth)
+        self.stopped = threading.Event()
+        # Held while a file is being read and searched.
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for path in self.query.iter_paths():
+                with self.lock:
+                    if self.stopped.is_set():
+                        return
+                    item = self._prepare(path)
+                if item is not None and not self._put(item):
+                    return
+        except Exception:
+            self._put(('error', sys.exc_info()))
+        else:
+            self._put(('done',))
+
+    def _prepare(self, path):
+        # Returns the item to queue for the file at `path`, if it has
+        # patches to suggest.
+        try:
+            buffer = self.query.open_buffer(path)
+        except IOError:
+            return None
+        if buffer is None:
+            return None
+        patches = self.query.suggest(list(buffer.lines))
+        if not patches:
+            self.query.note_clean(path, buffer.signature)
+            return None
+        return 'file', buffer, patches
+
+    def _put(self, item):
+        """
+        Waits for room in the queue, unless the prefetcher is closed first.
+        Returns whether the item was queued.
+        """
+        import Queue
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        import Queue
+        while True:
+            # (Waiting with a timeout lets KeyboardInterrupt through.)
+            try:
+                item = self.queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if item[0] == 'done':
+                return
+            if item[0] == 'error':
+                exception_type, exception, traceback = item[1]
+                raise exception_type, exception, traceback
+            yield item[1], item[2]
+
+    def close(self):
+        with self.lock:
+            self.stopped.set()
+
+
+def mmap_matches(mapping, suggestor):
+    """
+    Generates (line number, start offset, end offset, replacement) for each
+    change `suggestor` suggests for the contents of `mapping`, which is
+    typically a read-only mmap of a file.  The replacement is None for matches
+    that are only flagged.
+
+    Suggestors made by multiline_regex_suggestor have their regex run over the
+    mapping as a whole; matches don't overlap, as with re.sub.  Suggestors
+    made by line_transformation_suggestor (including regex_suggestor) see one
+    line at a time, but only lines where a search of the mapping found a
+    candidate match are copied out, if the suggestor has a regex.  Either way,
+    line numbers are only worked out for the matches.
+    """
+    regex = getattr(suggestor, 'regex', None)
+    line_number = counted = 0
+    if getattr(suggestor, 'multiline', False):
+        substitution = suggestor.substitution
+        matches = _sub_matches(regex, mapping)
+        if _progress is not None:
+            matches = _watched_matches(matches, _progress)
+        for match in matches:
+            start, end = match.span()
+            if _after_last_line(mapping, start):
+                break
+            line_number += _count_newlines(mapping, counted, start)
+            counted = start
+            if substitution is None:
+                replacement = None
+            elif isinstance(substitution, str):
+                replacement = match.expand(substitution)
+            else:
+                replacement = substitution(match)
+            if replacement is not None and replacement == match.group():
+                continue
+            yield line_number, start, end, replacement
+        return
+
+    transformation = getattr(suggestor, 'line_transformation', None)
+    if transformation is None:
+        raise ValueError('Suggestor can\'t be used with the mmap engine')
+    line_filter = suggestor.line_filter
+    search = None if regex is None else _whole_file_search(regex)
+    spans = _candidate_lines(mapping, search)
+    if _progress is not None:
+        spans = _watched_spans(spans, _progress)
+    for start, end in spans:
+        line = mapping[start:end]
+        if line_filter and not line_filter(line):
+            continue
+        candidate = transformation(line)
+        if candidate == line:
+            continue
+        line_number += _count_newlines(mapping, counted, start)
+        counted = start
+        yield line_number, start, end, candidate
+
+
+@_timed('match')
+def mmap_count_matches(path, suggestor):
+    """
+    Like Query.count_matches, but over a memory-mapped file.
+    """
+    mapping = _map_file(path)
+    if mapping is None:
+        return 0
+    try:
+        regex = getattr(suggestor, 'regex', None)
+        if regex is None:
+            return sum(1 for _ in mmap_matches(mapping, suggestor))
+        if suggestor.multiline:
+            matches = _sub_matches(regex, mapping)
+            if _progress is not None:
+                matches = _watched_matches(matches, _progress)
+            return sum(1 for match in matches
+                       if not _after_last_line(mapping, match.start()))
+        line_filter = suggestor.line_filter
+        count = 0
+        spans = _candidate_lines(mapping, _whole_file_search(regex))
+        if _progress is not None:
+            spans = _watched_spans(spans, _progress)
+        for start, end in spans:
+            line = mapping[start:end]
+            if ((line_filter is None or line_filter(line)) and
+                    regex.search(line)):
+                count += 1
+        return count
+    finally:
+        mapping.close()
+
+
+@_timed('match')
+def mmap_apply_patches(path, suggestor, fsync=False):
+    """
+    Like Query.apply_patches, but over a memory-mapped file.  The new contents
+    are streamed to a temporary file which then replaces the original, so the
+    file is never held in memory as a whole.
+
+    The changes are those the lines engine makes:
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'a.txt')
+    >>> text = 'foo(1,\\n    2)\\nbar foo\\n\\nfoo'
+    >>> suggestors = [
+    ...     regex_suggestor('fo+', 'F'),
+    ...     regex_suggestor('bar'),
+    ...     multiline_regex_suggestor(r'foo\\((.*?)\\)', r'foo[\\1]',
+    ...                               overlapping=False),
+    ... ]
+    >>> for suggestor in suggestors:
+    ...     results = []
+    ...     for engine in ('lines', 'mmap'):
+    ...         with open(path, 'w') as file_w:
+    ...             file_w.write(text)
+    ...         applied = Query(suggestor, engine=engine).apply_patches(path)
+    ...         results.append((applied, open(path).read()))
+    ...     print results[0] == results[1], results[1]
+    True ((3, 0), 'F(1,\\n    2)\\nbar F\\n\\nF')
+    True ((0, 1), 'foo(1,\\n    2)\\nbar foo\\n\\nfoo')
+    True ((1, 0), 'foo[1,\\n    2]\\nbar foo\\n\\nfoo')
+    """
+    mapping = _map_file(path)
+    if mapping is None:
+        return 0, 0
+    applied = flagged = 0
+    output = None
+    try:
+        copied = 0
+        for _, start, end, replacement in mmap_matches(mapping, suggestor):
+            if replacement is None:
+                flagged += 1
+                continue
+            if output is None:
+                output = _AtomicFile(path)
+            _copy_range(mapping, copied, start, output)
+            output.write(replacement)
+            copied = end
+            applied += 1
+        if output is not None:
+            _copy_range(mapping, copied, len(mapping), output)
+            output.commit(fsync)
+            output = None
+    finally:
+        if output is not None:
+            output.discard()
+        mapping.close()
+    return applied, flagged
+
+
+def _line_changer(suggestor):
+    """
+    Returns a function that takes a line and returns what a per-line
+    suggestor (one made by line_transformation_suggestor, including
+    regex_suggestor) would replace it with: the line itself if it wouldn't
+    suggest anything, or None if it would only flag the line.
+    """
+    transformation = getattr(suggestor, 'line_transformation', None)
+    if transformation is None:
+        raise ValueError('Suggestor can\'t be used with the stream engine')
+    line_filter = suggestor.line_filter
+    if line_filter is None:
+        return transformation
+
+    def change(line):
+        if not line_filter(line):
+            return line
+        return transformation(line)
+    return change
+
+
+def _open_stream(path):
+    file_r = open(path, 'rb')
+    if _stats is not None:
+        _stats.opened(path, os.fstat(file_r.fileno()).st_size)
+    return file_r
+
+
+@_timed('match')
+def stream_count_matches(path, suggestor):
+    """
+    Like Query.count_matches, but reading the file a line at a time.
+    """
+    change = _line_changer(suggestor)
+    with _open_stream(path) as file_r:
+        lines = file_r
+        if _progress is not None:
+            lines = _watched_lines(lines, _progress)
+        return sum(1 for line in lines if change(line) != line)
+
+
+@_timed('match')
+def stream_apply_patches(path, suggestor, fsync=False):
+    """
+    Like Query.apply_patches, but for per-line suggestors, reading the file a
+    line at a time.  Once the first line is changed, the lines are written to
+    a temporary file which then replaces the original, so only one line is
+    held in memory at a time.
+
+    The unchanged lines before the first change are copied a chunk at a
+    time, however many chunks they take:
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'a.txt')
+    >>> lines = ['%099d\\n' % number for number in xrange(30000)]
+    >>> lines[25000] = lines[-1] = 'foo\\n'
+    >>> with open(path, 'w') as file_w:
+    ...     file_w.writelines(lines)
+    >>> os.path.getsize(path) > 2 << 20
+    True
+    >>> stream_apply_patches(path, regex_suggestor('foo', 'bar'))
+    (2, 0)
+    >>> open(path).read() == ''.join(lines).replace('foo', 'bar')
+    True
+    """
+    change = _line_changer(suggestor)
+    applied = flagged = 0
+    output = None
+    offset = 0
+    try:
+        with _open_stream(path) as file_r:
+            lines = file_r
+            if _progress is not None:
+                lines = _watched_lines(lines, _progress)
+            for line in lines:
+                candidate = change(line)
+                if candidate is None:
+                    flagged += 1
+                elif candidate != line:
+                    if output is None:
+                        output = _AtomicFile(path)
+                        # Copy the unchanged lines so far.
+                        with open(path, 'rb') as original:
+                            _copy_file(original, offset, output)
+                    output.write(candidate)
+                    applied += 1
+                    continue
+                if output is not None:
+                    output.write(line)
+                else:
+                    offset += len(line)
+        if output is not None:
+            output.commit(fsync)
+            output = None
+    finally:
+        if output is not None:
+            output.discard()
+    return applied, flagged
+
+
+def _copy_file(file_r, size, output, chunk_size=1 << 20):
+    """Copies the first `size` bytes of `file_r` to `output`."""
+    while size > 0:
+        chunk = file_r.read(min(size, chunk_size))
+        if not chunk:
+            break
+        output.write(chunk)
+        size -= len(chunk)
+
+
+@_timed('match')
+def stream_export_patches(path, suggestor, format='jsonl', context=3):
+    """
+    Like Query.export_patches, but for per-line suggestors, reading the file a
+    line at a time.  Apart from the output, which grows with the number of
+    changes, no more than `context` lines are held in memory.
+    """
+    change = _line_changer(suggestor)
+    if format == 'jsonl':
+        import hashlib
+        content_hash = hashlib.sha1()
+        with _open_stream(path) as file_r:
+            for chunk in iter(lambda: file_r.read(1 << 20), ''):
+                content_hash.update(chunk)
+        content_hash = content_hash.hexdigest()
+        records = []
+        with open(path, 'rb') as file_r:
+            lines = file_r
+            if _progress is not None:
+                lines = _watched_lines(lines, _progress)
+            for line_number, line in enumerate(lines):
+                candidate = change(line)
+                if candidate == line:
+                    continue
+                records.append(_encode_message({
+                    'path': path,
+                    'start': line_number,
+                    'end': line_number + 1,
+                    'old_lines': [line],
+                    'new_lines': None if candidate is None else [candidate],
+                    'hash': content_hash,
+                }))
+        return ''.join(records), len(records)
+
+    with _open_stream(path) as file_r:
+        diff = _StreamingDiff(path, context)
+        lines = file_r
+        if _progress is not None:
+            lines = _watched_lines(lines, _progress)
+        for line in lines:
+            candidate = change(line)
+            if candidate is None or candidate == line:
+                diff.same(line)
+            else:
+                diff.changed(line, candidate)
+        return diff.finish(), diff.count
+
+
+class _StreamingDiff(object):
+    r"""
+    Builds a unified diff of a file from its lines as they go by, each one
+    either unchanged or changed into some others, holding on to no more than
+    `context` unchanged lines that might be needed as context for a later
+    change.
+
+    >>> diff = _StreamingDiff('x', context=1)
+    >>> for line in 'abcdefg':
+    ...     if line in 'bf':
+    ...         diff.changed(line + '\n', line.upper() + '\n')
+    ...     else:
+    ...         diff.same(line + '\n')
+    >>> print diff.finish(),
+    --- a/x
+    +++ b/x
+    @@ -1,3 +1,3 @@
+     a
+    -b
+    +B
+     c
+    @@ -5,3 +5,3 @@
+     e
+    -f
+    +F
+     g
+    """
+
+    def __init__(self, path, context=3):
+        self.output = ['--- a/%s\n' % path, '+++ b/%s\n' % path]
+        self.context = context
+        self.count = 0
+        self.old_line_number = self.new_line_number = 0
+        # Unchanged lines that aren't part of a hunk (yet).
+        self.before = collections.deque(maxlen=context)
+        # Unchanged lines since the last change.
+        self.unchanged = 0
+        self.hunk = None
+        self.removed = []
+        self.added = []
+
+    def same(self, line):
+        self._flush_change()
+        self.old_line_number += 1
+        self.new_line_number += 1
+        self.unchanged += 1
+        hunk = self.hunk
+        if hunk is not None and self.unchanged <= self.context:
+            hunk['body'].append((' ', line))
+            hunk['old'] += 1
+            hunk['new'] += 1
+        else:
+            self.before.append(line)
+
+    def changed(self, old_line, new_text):
+        self.count += 1
+        if self.hunk is not None and self.unchanged > 2 * self.context:
+            self._close()
+        if self.hunk is None:
+            self.hunk = {
+                'old_start': self.old_line_number - len(self.before),
+                'new_start': self.new_line_number - len(self.before),
+                'old': 0, 'new': 0, 'body': [],
+            }
+        hunk = self.hunk
+        # The lines between the last change and this one, if they weren't
+        # all added already as trailing context.
+        for line in self.before:
+            hunk['body'].append((' ', line))
+        hunk['old'] += len(self.before)
+        hunk['new'] += len(self.before)
+        self.before.clear()
+
+        new_lines = _split_lines(new_text)
+        self.removed.append(old_line)
+        self.added.extend(new_lines)
+        hunk['old'] += 1
+        hunk['new'] += len(new_lines)
+        self.old_line_number += 1
+        self.new_line_number += len(new_lines)
+        self.unchanged = 0
+
+    def _flush_change(self):
+        """Adds the run of changed lines just seen to the hunk."""
+        if self.removed:
+            body = self.hunk['body']
+            body.extend(('-', line) for line in self.removed)
+            body.extend(('+', line) for line in self.added)
+            self.removed, self.added = [], []
+
+    def _close(self):
+        self._flush_change()
+        hunk, self.hunk = self.hunk, None
+        old_start, new_start = hunk['old_start'], hunk['new_start']
+        self.output.append('@@ -%s +%s @@\n' % (
+            _hunk_range(old_start, old_start + hunk['old']),
+            _hunk_range(new_start, new_start + hunk['new'])
+        ))
+        for prefix, line in hunk['body']:
+            _emit_diff_line(self.output, prefix, line)
+
+    def finish(self):
+        """Returns the diff, or '' if nothing changed."""
+        if self.hunk is not None:
+            self._close()
+        if not self.count:
+            return ''
+        return ''.join(self.output)
+
+
+def _map_file(path):
+    """
+    Returns a read-only mmap of the file at `path`, or None if it's empty
+    (empty files can't be mapped).
+    """
+    import mmap
+    file_r = open(path, 'rb')
+    try:
+        size = os.fstat(file_r.fileno()).st_size
+        if _stats is not None:
+            _stats.opened(path, size)
+        if size == 0:
+            return None
+        return mmap.mmap(file_r.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        file_r.close()
+
+
+def _whole_file_search(regex):
+    """
+    Returns the search method of a version of the per-line `regex` that finds
+    a match in a whole file whenever one of its lines has one, or None if
+    there isn't one (see _analyze_pattern).
+    """
+    _, line_independent = _analyze_pattern(regex)
+    if not line_independent:
+        return None
+    return re.compile(regex.pattern, regex.flags | re.MULTILINE).search
+
+
+def _candidate_lines(text, search=None):
+    r"""
+    Generates the (start, end) offsets of the lines of `text` in which
+    `search` finds a match, or of every line if `search` is None.  (Once a
+    match is found, searching resumes at the start of the next line.)
+
+    >>> text = 'a\nbc\nd'
+    >>> list(_candidate_lines(text))
+    [(0, 2), (2, 5), (5, 6)]
+    >>> list(_candidate_lines(text, re.compile('[ad]', re.MULTILINE).search))
+    [(0, 2), (5, 6)]
+    """
+    size = len(text)
+    position = 0
+    while position < size:
+        if search is None:
+            start = position
+        else:
+            match = search(text, position)
+            if match is None:
+                return
+            start = max(position, text.rfind('\n', position,
+                                             match.start()) + 1)
+            if start >= size:
+                return
+        newline = text.find('\n', start)
+        end = size if newline < 0 else newline + 1
+        yield start, end
+        position = end
+
+
+def _count_newlines(text, start, end, chunk_size=1 << 20):
+    """
+    Counts the newlines in text[start:end], copying at most `chunk_size`
+    characters at a time.
+    """
+    count = 0
+    while start < end:
+        stop = min(end, start + chunk_size)
+        count += text[start:stop].count('\n')
+        start = stop
+    return count
+
+
+def _copy_range(text, start, end, output, chunk_size=1 << 20):
+    """
+    Writes text[start:end] to `output`, copying at most `chunk_size`
+    characters at a time.
+    """
+    while start < end:
+        stop = min(end, start + chunk_size)
+        output.write(text[start:stop])
+        start = stop
+
+
+class _AtomicFile(object):
+    """
+    A temporary file, next to the file at `path`, that replaces it when
+    committed.  Until then, the original file is left untouched.
+
+    If `path` is a symbolic link, the file it points to is replaced, as
+    writing to the link would.
+    """
+
+    def __init__(self, path):
+        import tempfile
+        path = os.path.realpath(path)
+        directory, name = os.path.split(path)
+        fd, self.temp_path = tempfile.mkstemp(
+            prefix='.%s.' % name, suffix='.modone', dir=directory
+        )
+        self.path = path
+        self.file = os.fdopen(fd, 'wb')
+        self.write = self.file.write
+
+    @_timed('write')
+    def commit(self, fsync=False):
+        if _stats is not None:
+            _stats.count('bytes_written', self.file.tell())
+        try:
+            os.chmod(self.temp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+        except OSError:
+            pass
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        # Atomically replaces the original on POSIX systems.
+        os.rename(self.temp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except OSError:
+            pass
+
+
+class OffsetMap(object):
+    """
+    Maps ranges of positions (e.g. line numbers) in the original version of a
+    file to the corresponding ranges in its current version, given the edits
+    that have been made to it since.
+
+    Edits are kept as a list of non-overlapping ranges of original positions,
+    sorted by position, along with the running total of how much each one and
+    those before it moved what follows.  Rebasing a range is a bisection;
+    recording an edit is constant time when edits come in order of position,
+    as they usually do.
+
+    >>> offsets = OffsetMap()
+    >>> offsets.record(2, 4, 3)    # lines 2 and 3 replaced by three lines
+    >>> offsets.record(0, 1, 0)    # line 0 deleted
+    >>> offsets.rebase(1, 2), offsets.rebase(5, 7)
+    ((0, 1), (5, 7))
+    >>> print offsets.rebase(3, 5)   # overlaps an edit
+    None
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._shifts = []
+
+    def record(self, start, end, length):
+        """
+        Records that the original range [start, end), which mustn't overlap
+        any range already recorded, now has length `length`.
+        """
+        delta = length - (end - start)
+        index = bisect.bisect_right(self._starts, start)
+        shift = self._shifts[index - 1] if index else 0
+        self._starts.insert(index, start)
+        self._ends.insert(index, end)
+        self._shifts.insert(index, shift + delta)
+        shifts = self._shifts
+        for i in xrange(index + 1, len(shifts)):
+            shifts[i] += delta
+
+    def rebase(self, start, end):
+        """
+        Returns the current position of the original range [start, end), or
+        None if it overlaps an edit.
+        """
+        # Edits are sorted by end as well as by start, since they don't
+        # overlap.
+        index = bisect.bisect_right(self._ends, start)
+        if index < len(self._starts) and self._starts[index] < end:
+            return None
+        shift = self._shifts[index - 1] if index else 0
+        return start + shift, end + shift
+
+
+class _EditTracker(object):
+    """
+    Keeps track of the patches applied to a FileBuffer since a snapshot of its
+    lines was taken, so that the patches suggested for the snapshot can be
+    rebased onto the buffer.
+
+    Line-level patches are rebased by line number.  SpanPatches are rebased by
+    character offset, so that any number of them can apply to the same line,
+    and their lines and columns in the buffer are worked out from those in
+    the snapshot (see _relocate).
+    """
+
+    def __init__(self, buffer, snapshot):
+        self.buffer = buffer
+        self.snapshot = snapshot
+        self.line_offsets = OffsetMap()
+        self.char_offsets = OffsetMap()
+        self.edited = False
+        self._snapshot_index = None
+        # The snapshot offset where the furthest applied patch ends, and
+        # (row, column) of that place in the snapshot and in the buffer.
+        self._end_offset = 0
+        self._end_position = None
+
+    def rebase(self, patch):
+        """
+        Moves `patch` from its position in the snapshot to its position in the
+        buffer.  Returns its original position (to be passed to `record`), or
+        None if it overlaps a patch that has been applied.
+        """
+        if isinstance(patch, SpanPatch):
+            original = (patch.start_line_number, patch.end_line_number,
+                        patch.start, patch.end, patch.end_col)
+            rebased = self.char_offsets.rebase(patch.start, patch.end)
+            if rebased is None:
+                return None
+            if self.edited:
+                self._relocate(patch, *rebased)
+        else:
+            original = (patch.start_line_number, patch.end_line_number,
+                        None, None, None)
+            rebased = self.line_offsets.rebase(*original[:2])
+            if rebased is None:
+                return None
+            patch.start_line_number, patch.end_line_number = rebased
+        return original
+
+    def _relocate(self, patch, start, end):
+        """
+        Moves a SpanPatch, located in the snapshot, to [start, end) in the
+        buffer.  Only the patches applied before it on its first line move its
+        columns, so its place in the buffer follows from where the last of
+        them ended, or else from its line number, without indexing the
+        buffer's lines again.
+        """
+        row, col = patch.start_line_number, patch.start_col
+        rows = patch.end_line_number - row
+        new_row = None
+        if patch.start >= self._end_offset:
+            position = self._end_position
+            if position is not None and position[0] == row:
+                new_row, new_col = position[2], position[3] + col - position[1]
+            else:
+                rebased = self.line_offsets.rebase(row, row + rows)
+                if rebased is not None:
+                    new_row, new_col = rebased[0], col
+        if new_row is None:
+            # (Patches applied out of order.)
+            patch.locate(_LineIndex(self.buffer.lines), start, end)
+            return
+        if rows == 1:
+            patch.end_col += new_col - col
+        patch.start, patch.end = start, end
+        patch.start_line_number, patch.start_col = new_row, new_col
+        patch.end_line_number = new_row + rows
+
+    def record(self, patch, original):
+        """Records that `patch`, originally at `original`, was applied."""
+        start_line, end_line, start, end, end_col = original
+        self.edited = True
+        if isinstance(patch, SpanPatch):
+            self.line_offsets.record(start_line, end_line,
+                                     patch.applied_line_count)
+            self.char_offsets.record(start, end, len(patch.replacement))
+            end_position = self._span_end_position(patch, end_line, end_col)
+        else:
+            self.line_offsets.record(start_line, end_line,
+                                     len(patch.new_lines))
+            if self._snapshot_index is None:
+                self._snapshot_index = _LineIndex(self.snapshot)
+            start = self._snapshot_index.line_start(start_line)
+            end = self._snapshot_index.line_start(end_line)
+            self.char_offsets.record(
+                start, end, sum(len(line) for line in patch.new_lines)
+            )
+            end_position = (end_line, 0,
+                            patch.start_line_number + len(patch.new_lines), 0)
+        if end >= self._end_offset:
+            self._end_offset = end
+            self._end_position = end_position
+
+    def _span_end_position(self, patch, end_line, end_col):
+        # Where an applied SpanPatch, originally ending at `end_col` of the
+        # line before `end_line`, ends in the snapshot and in the buffer.
+        if end_col == len(self.snapshot[end_line - 1]):
+            # The rest of the buffer's lines weren't touched.
+            return (end_line, 0,
+                    patch.start_line_number + patch.applied_line_count, 0)
+        replacement = patch.replacement
+        newlines = replacement.count('\n')
+        if newlines:
+            column = len(replacement) - replacement.rfind('\n') - 1
+        else:
+            column = patch.start_col + len(replacement)
+        return (end_line - 1, end_col,
+                patch.start_line_number + newlines, column)
+
+
+class _ChangedRegions(object):
+    """
+    The regions of a list of lines that have been replaced, kept in order and
+    merged where they touch, so that a diff of the lines can be made without
+    comparing them.
+
+    >>> changes = _ChangedRegions()
+    >>> changes.add(1, 2, 3)    # line 1 replaced by three lines
+    >>> changes.add(2, 3, 1)    # then the second of those replaced
+    >>> changes.add(6, 6, 1)    # and a line inserted further down
+    >>> [region.old_range() for region in changes.regions]
+    [(1, 2), (4, 4)]
+    >>> [(region.start, region.end) for region in changes.regions]
+    [(1, 4), (6, 7)]
+    """
+
+    class Region(object):
+        def __init__(self, start, end, delta):
+            # The current range of lines, and how many lines longer it is
+            # than the range it replaced.
+            self.start, self.end, self.delta = start, end, delta
+            self.shift = 0
+
+        def old_range(self):
+            start = self.start - self.shift
+            return start, start + (self.end - self.start) - self.delta
+
+    def __init__(self):
+        self.regions = []
+        self.count = 0
+
+    def add(self, start, end, length):
+        """
+        Records that the current lines [start, end) were replaced by `length`
+        lines.
+        """
+        self.count += 1
+        delta = length - (end - start)
+        regions = self.regions
+        # Regions are usually added in order, so search from the back.
+        first = len(regions)
+        while first and regions[first - 1].end >= start:
+            first -= 1
+        last = first
+        while last < len(regions) and regions[last].start <= end:
+            last += 1
+        merged = regions[first:last]
+        if merged:
+            start = min(start, merged[0].start)
+            end = max(end, merged[-1].end)
+        region = self.Region(start, end + delta,
+                             delta + sum(r.delta for r in merged))
+        region.shift = (regions[first - 1].shift + regions[first - 1].delta
+                        if first else 0)
+        regions[first:last] = [region]
+        for following in regions[first + 1:]:
+            following.start += delta
+            following.end += delta
+            following.shift += delta
+
+
+def _unified_diff(path, old_lines, new_lines, changes, context=3):
+    """
+    Returns a unified diff between `old_lines` and `new_lines`, given the
+    _ChangedRegions that turned one into the other.
+    """
+    hunks = []
+    for region in changes.regions:
+        old_start, old_end = region.old_range()
+        if hunks and old_start - hunks[-1][-1][1] <= 2 * context:
+            hunks[-1].append((old_start, old_end, region.start, region.end))
+        else:
+            hunks.append([(old_start, old_end, region.start, region.end)])
+    if not hunks:
+        return ''
+    # Per-line suggestors may replace a line with text that has newlines in
+    # it; the diff needs those as separate lines.
+    new_lines, new_index = _split_embedded_lines(new_lines)
+
+    output = ['--- a/%s\n' % path, '+++ b/%s\n' % path]
+    emit = functools.partial(_emit_diff_line, output)
+    for hunk in hunks:
+        old_start = max(0, hunk[0][0] - context)
+        old_end = min(len(old_lines), hunk[-1][1] + context)
+        new_start = new_index[hunk[0][2]] - (hunk[0][0] - old_start)
+        new_end = new_index[hunk[-1][3]] + (old_end - hunk[-1][1])
+        output.append('@@ -%s +%s @@\n' % (
+            _hunk_range(old_start, old_end), _hunk_range(new_start, new_end)
+        ))
+        position = old_start
+        for region_old_start, region_old_end, start, end in hunk:
+            for line in old_lines[position:region_old_start]:
+                emit(' ', line)
+            for line in old_lines[region_old_start:region_old_end]:
+                emit('-', line)
+            for line in new_lines[new_index[start]:new_index[end]]:
+                emit('+', line)
+            position = region_old_end
+        for line in old_lines[position:old_end]:
+            emit(' ', line)
+    return ''.join(output)
+
+
+def _split_embedded_lines(lines):
+    """
+    Returns `lines` with any line that has a newline inside it split up, and a
+    list mapping each index into `lines` (and its end) to the index into the
+    result.
+
+    >>> _split_embedded_lines(['a\\n', 'b\\nc\\n', 'd'])
+    (['a\\n', 'b\\n', 'c\\n', 'd'], [0, 1, 3, 4])
+    """
+    split, index = [], []
+    for line in lines:
+        index.append(len(split))
+        if '\n' in line[:-1]:
+            split.extend(_split_lines(line))
+        else:
+            split.append(line)
+    index.append(len(split))
+    return split, index
+
+
+def _emit_diff_line(output, prefix, line):
+    output.append(prefix + line)
+    if not line.endswith('\n'):
+        output.append('\n\\ No newline at end of file\n')
+
+
+def _hunk_range(start, end):
+    """
+    Formats the range of lines [start, end) for a unified diff hunk header.
+
+    >>> _hunk_range(0, 1), _hunk_range(4, 7), _hunk_range(4, 4)
+    ('1', '5,3', '4,0')
+    """
+    if end - start == 1:
+        return '%d' % (start + 1)
+    if end == start:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, end - start)
+
+
+def _content_hash(lines):
+    import hashlib
+    return hashlib.sha1(''.join(lines)).hexdigest()
+
+
+class ScanCache(object):
+    """
+    Remembers, from one run to the next, the files a query had nothing to
+    suggest for and the patches the user rejected, so that running the same
+    query again only looks at what's left.
+
+    Entries are kept per query (see query_key) and per file.  A file only
+    counts as clean while its inode, size and modification time are
+    unchanged.  Rejected patches are remembered by their contents (see
+    _patch_fingerprint), so they are recognized wherever they end up in the
+    file.
+
+    The entries are spread over SHARDS files by a hash of the file's path.
+    Each one is read when an entry in it is first looked up, and written
+    back only if an entry in it changed, so a run over a few files reads and
+    writes a few small files, however much is cached.  About `max_entries`
+    files are remembered (each shard holds up to a quarter more than its
+    share, as they don't fill up evenly); the least recently used in a shard
+    are forgotten first.
+
+    >>> cache = ScanCache(None)    # kept in memory only
+    >>> cache.mark_clean('q', 'x.txt', (1, 2, 3.5))
+    >>> cache.is_clean('q', 'x.txt', (1, 2, 3.5))
+    True
+    >>> cache.is_clean('q', 'x.txt', (1, 5, 4.0))
+    False
+    >>> cache.reject('q', 'x.txt', 'abc')
+    >>> cache.is_rejected('q', 'x.txt', 'abc')
+    True
+
+    Looking entries up leaves nothing to save:
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> cache = ScanCache(directory)
+    >>> cache.mark_clean('q', 'x.txt', (1, 2, 3.5))
+    >>> cache.save()
+    >>> len(os.listdir(directory))    # one shard
+    1
+    >>> cache = ScanCache(directory)
+    >>> cache.is_clean('q', 'x.txt', (1, 2, 3.5)), cache.dirty
+    (True, set([]))
+    """
+
+    VERSION = 2
+    SHARDS = 256
+
+    def __init__(self, path, max_entries=50000):
+        """
+        @param path  The directory to keep the cache in, or None to keep it
+                     only in memory.  Missing or unreadable files in it are
+                     treated as empty.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        # The entries in each shard looked at so far, by shard number.
+        self.shards = {}
+        # The numbers of the shards that have changed.
+        self.dirty = set()
+
+    def _locate(self, key, path):
+        # The key of the entry for `path`, and the number of its shard.
+        import hashlib
+        entry_key = '%s:%s' % (key, os.path.abspath(path))
+        number = int(hashlib.sha1(entry_key).hexdigest()[:8], 16)
+        return entry_key, number % self.SHARDS
+
+    def _shard_path(self, number):
+        return os.path.join(self.path, '%02x.json' % number)
+
+    def _load(self, number):
+        if self.path is None:
+            return {}
+        try:
+            with open(self._shard_path(number)) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return {}
+        return data.get('entries', {})
+
+    def _entry(self, key, path, create=False):
+        entry_key, number = self._locate(key, path)
+        entries = self.shards.get(number)
+        if entries is None:
+            entries = self.shards[number] = self._load(number)
+        entry = entries.get(entry_key)
+        if entry is None and create:
+            entry = entries[entry_key] = {
+                'signature': None, 'rejected': []
+            }
+            self.dirty.add(number)
+        if entry is not None:
+            # (Only saved along with a change to the same shard.)
+            entry['used'] = time.time()
+        return entry
+
+    def _changed(self, key, path):
+        self.dirty.add(self._locate(key, path)[1])
+
+    def is_clean(self, key, path, signature=None):
+        """
+        Returns whether the query with `key` had nothing to suggest for the
+        file at `path`, as it is now (or as of `signature`).
+        """
+        entry = self._entry(key, path)
+        if entry is None or entry['signature'] is None:
+            return False
+        if signature is None:
+            try:
+                signature = _stat_signature(os.stat(path))
+            except OSError:
+                return False
+        return entry['signature'] == list(signature)
+
+    def mark_clean(self, key, path, signature=None):
+        if signature is None:
+            try:
+                signature = _stat_signature(os.stat(path))
+            except OSError:
+                return
+        entry = self._entry(key, path, create=True)
+        if entry['signature'] != list(signature):
+            entry['signature'] = list(signature)
+            self._changed(key, path)
+
+    def is_rejected(self, key, path, fingerprint):
+        entry = self._entry(key, path)
+        return entry is not None and fingerprint in entry['rejected']
+
+    def reject(self, key, path, fingerprint):
+        rejected = self._entry(key, path, create=True)['rejected']
+        if fingerprint not in rejected:
+            rejected.append(fingerprint)
+            self._changed(key, path)
+
+    def save(self):
+        """
+        Writes out (atomically) the shards that have changed, evicting the
+        least recently used entries beyond each one's share of max_entries.
+        """
+        if self.path is None or not self.dirty:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        limit = int(ceil(1.25 * self.max_entries / self.SHARDS))
+        for number in sorted(self.dirty):
+            entries = self.shards[number]
+            if len(entries) > limit:
+                by_use = sorted(entries, key=lambda entry_key: entries[
+                    entry_key].get('used', 0))
+                for entry_key in by_use[:len(entries) - limit]:
+                    del entries[entry_key]
+            file_w = _AtomicFile(self._shard_path(number))
+            try:
+                json.dump({'version': self.VERSION, 'entries': entries},
+                          file_w.file)
+                file_w.commit()
+            except BaseException:
+                file_w.discard()
+                raise
+        self.dirty = set()
+
+
+def default_cache_path():
+    """Where the command line keeps its ScanCache."""
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'modone', 'scan-cache')
+
+
+def query_key(suggestor):
+    """
+    Returns a string identifying what `suggestor` looks for and suggests, for
+    suggestors made by regex_suggestor, multiline_regex_suggestor and
+    rules_suggestor (or combine_suggestors, from those), or None for any
+    other (or one with a function for a substitution), whose results can't
+    be cached.
+
+    >>> query_key(regex_suggestor('a+', 'b')) == query_key(
+    ...     regex_suggestor('a+', 'b'))
+    True
+    >>> query_key(regex_suggestor('a+', 'c')) == query_key(
+    ...     regex_suggestor('a+', 'b'))
+    False
+    >>> query_key(line_transformation_suggestor(str.upper)) is None
+    True
+    """
+    import hashlib
+    parts = getattr(suggestor, 'suggestors', None)
+    if parts is not None:
+        keys = map(query_key, parts)
+        if None in keys:
+            return None
+        return hashlib.sha1(json.dumps([suggestor.overlaps, keys])).hexdigest()
+
+    rules = getattr(suggestor, 'rules', None)
+    if rules is None:
+        rules = [suggestor]
+    description = []
+    for rule in rules:
+        regex = getattr(rule, 'regex', None)
+        substitution = getattr(rule, 'substitution', None)
+        if (regex is None or callable(substitution) or
+                getattr(rule, 'line_filter', None) is not None):
+            return None
+        description.append([regex.pattern, regex.flags, substitution,
+                            rule.multiline])
+    return hashlib.sha1(json.dumps(description)).hexdigest()
+
+
+def _patch_fingerprint(patch):
+    """
+    Identifies a patch by the lines it applies to (and the lines around
+    them) and what it would replace them with, as of now, so that it's still
+    recognized after patches before it have moved it.
+    """
+    import hashlib
+    lines = _patch_buffer(patch).lines
+    context = lines[max(0, patch.start_line_number - 1):
+                    patch.end_line_number + 1]
+    new_lines = patch.replacement_lines(lines)
+    return hashlib.sha1('%r\0%r' % (context, new_lines)).hexdigest()[:20]
 
 
-class Query(object):
+class FileBuffer(object):
     """
-    Represents a suggestor, along with a set of constraints on which files
-    should be fed to that suggestor.
+    The lines of a file, shared by the query generating patches for it and by
+    the code showing and applying those patches.  The file is only read again
+    when it has changed on disk, as judged by its inode, size and modification
+    time.
 
+    Patches applied to the buffer are only written out by `flush`.
     """
 
-    def __init__(self, suggestor, path):
+    def __init__(self, path, text=None, signature=None):
+        """
+        @param text       The contents of the file, if they have already been
+                          read (along with their `signature`, see
+                          _read_file).
+        """
+        self.path = path
+        self.lines = []
+        self.dirty = False
+        self._signature = None
+        self._index = None
+        if text is None:
+            self.load()
+        else:
+            self.lines[:] = _split_lines(text)
+            self._signature = signature
 
+    def load(self):
         """
-        @param suggestor            A function that takes a list of lines and
-                                    generates instances of Patch to suggest.
-                                    (Patches should not specify paths.)
+        Reads the file.  `lines` is updated in place, so that anyone holding on
+        to it sees the new contents.
+        """
+        if self._signature is not None and _stats is not None:
+            _stats.count('files_reread')
+        text, self._signature = _read_file(self.path)
+        self.lines[:] = _split_lines(text)
+        self._index = None
 
+    @property
+    def signature(self):
         """
-        self.suggestor = suggestor
-        self.path = path
+        The signature (see _read_file) of the file as last read or written.
+        """
+        return self._signature
 
-    def generate_patches(self):
+    @property
+    def index(self):
         """
-        Generates a list of patches for file
-        that satisfy the given conditions given
-        query conditions, where patches for
-        each file are suggested by self.suggestor.
+        A _LineIndex of the buffer's lines, built when first needed after
+        they change.
         """
+        if self._index is None:
+            self._index = _LineIndex(self.lines)
+        return self._index
 
-        for path in [self.path]:
-            try:
-                lines = list(open(path))
-            except IOError:
-                # If we can't open the file--perhaps it's a symlink whose
-                # destination no loner exists--then short-circuit.
-                continue
+    def refresh(self):
+        """
+        Reloads the file if it has changed on disk, dropping any changes that
+        haven't been flushed.  Returns whether it did.
+        """
+        try:
+            signature = _stat_signature(os.stat(self.path))
+        except OSError:
+            return False
+        if signature == self._signature:
+            if _stats is not None:
+                _stats.count('reads_saved')
+            return False
+        self.load()
+        self.dirty = False
+        return True
 
-            for patch in self.suggestor(lines):
-                old_lines = lines[
-                    patch.start_line_number:patch.end_line_number]
-                if patch.new_lines is None or patch.new_lines != old_lines:
-                    patch.path = path
-                    yield patch
-                    # re-open file, in case contents changed
-                    lines[:] = list(open(path))
+    @_timed('apply')
+    def apply(self, patch):
+        if _stats is not None:
+            _stats.count('patches_accepted')
+        patch.apply_to(self.lines)
+        self._index = None
+        self.dirty = True
 
-    def run_interactive(self, **kargs):
-        run_interactive(self, **kargs)
+    @_timed('apply')
+    def replace_ranges(self, changes):
+        """
+        Replaces ranges of the buffer's text in one pass, given (start, end,
+        replacement) for each, in order and not overlapping, with offsets
+        into the text as it is now.
+        """
+        if _stats is not None:
+            _stats.count('patches_accepted', len(changes))
+        text = self.index.text
+        pieces = []
+        position = 0
+        for start, end, replacement in changes:
+            pieces.append(text[position:start])
+            pieces.append(replacement)
+            position = end
+        pieces.append(text[position:])
+        self.lines[:] = _split_lines(''.join(pieces))
+        self._index = None
+        self.dirty = True
+
+    def flush(self, fsync=False):
+        """
+        Writes the buffer out, if patches have been applied to it since it was
+        last written.
+        """
+        if self.dirty:
+            self.save(fsync)
+
+    def save(self, fsync=False):
+        _save(self.path, self.lines, fsync)
+        self._signature = _stat_signature(os.stat(self.path))
+        self.dirty = False
 
 
+@_timed('read')
+def _read_file(path):
+    """
+    Returns the contents of the file at `path`, along with the signature of
+    the file they were read from.
+    """
+    file_r = open(path)
+    try:
+        signature = _stat_signature(os.fstat(file_r.fileno()))
+        text = file_r.read()
+    finally:
+        file_r.close()
+    if _stats is not None:
+        _stats.opened(path, len(text))
+    return text, signature
+
+
+def _stat_signature(stat):
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+def _path_signature(path):
+    # None if the file is gone.
+    try:
+        return _stat_signature(os.stat(path))
+    except OSError:
+        return None
+
+
+# A place in a file; line_number and column count from 0.
+Position = collections.namedtuple('Position', 'path line_number column')
 
 
 class Patch(object):
@@ -241,6 +4305,10 @@ class Patch(object):
     ['a', 'b', 'X', 'Y', 'Z', 'e', 'f']
     """
 
+    # There can be millions of patches in a run, so they have no __dict__.
+    __slots__ = ('path', 'buffer', 'start_line_number', 'end_line_number',
+                 '_new_lines', 'applied', 'rule', 'fingerprint')
+
     def __init__(self, start_line_number, end_line_number=None, new_lines=None,
                  path=None):  # noqa
         """
@@ -265,27 +4333,94 @@ class Patch(object):
                                 (It'll get set by the suggestor's caller.)
         """
         self.path = path
+        # The FileBuffer holding the lines this patch was suggested for, if
+        # any.  (Also set by the suggestor's caller.)
+        self.buffer = None
         self.start_line_number = start_line_number
         self.end_line_number = end_line_number
         self.new_lines = new_lines
+        # Set once the patch has been applied, so that the Query that
+        # suggested it can rebase the patches that come after it.
+        self.applied = False
+        # The name of the rule that suggested the patch, if any (see
+        # rules_suggestor).
+        self.rule = None
+        # Set by the Query for the cache of rejected patches (see
+        # _patch_fingerprint).
+        self.fingerprint = None
 
         if self.end_line_number is None:
             self.end_line_number = self.start_line_number + 1
-        if isinstance(self.new_lines, str):
-            self.new_lines = self.new_lines.splitlines(True)
+
+    def __getstate__(self):
+        # (Patches are sent back from worker processes.)
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+    @property
+    def new_lines(self):
+        return self._new_lines
+
+    @new_lines.setter
+    def new_lines(self, new_lines):
+        if isinstance(new_lines, str):
+            new_lines = new_lines.splitlines(True)
+        self._new_lines = new_lines
+
+    @property
+    def suggests_change(self):
+        """
+        Whether the patch suggests new lines, rather than only flagging its
+        range.
+        """
+        return self._new_lines is not None
 
     def __repr__(self):
-        return 'Patch()' % ', '.join(map(repr, [
-            self.path,
+        return 'Patch(%s)' % ', '.join(map(repr, [
             self.start_line_number,
             self.end_line_number,
-            self.new_lines
+            self.new_lines,
+            self.path
         ]))
 
+    def replacement_lines(self, lines):
+        """
+        Returns the lines that applying the patch to `lines` would put in
+        place of its range, or None if it doesn't suggest a change.
+        """
+        return self.new_lines
+
+    def is_noop(self, lines):
+        """Returns whether applying the patch to `lines` would change them."""
+        new_lines = self._new_lines
+        if new_lines is None:
+            return False
+        start, end = self.start_line_number, self.end_line_number
+        # (Without slicing `lines`.)
+        return (len(new_lines) == end - start and
+                all(new_line == lines[start + i]
+                    for i, new_line in enumerate(new_lines)))
+
     def apply_to(self, lines):
         if self.new_lines is None:
             raise ValueError('Can\'t apply patch without suggested new lines.')
         lines[self.start_line_number:self.end_line_number] = self.new_lines
+        self.applied = True
+
+    @property
+    def start_position(self):
+        """
+        The Position where the patch starts.
+        """
+        return Position(self.path, self.start_line_number, 0)
 
     def render_range(self):
         path = self.path or '<unknown>'
@@ -298,12 +4433,280 @@ class Patch(object):
             )
 
 
+class SpanPatch(Patch):
+    r"""
+    Represents a range of characters in a file and (optionally) a string with
+    which to replace it.
+
+    The range is given by character offsets into the file's contents.  Its
+    line numbers (and columns) are worked out by `locate`; the affected lines
+    are only rebuilt when the patch is shown or applied.
+
+    >>> lines = ['say hello\n', 'to the world\n']
+    >>> p = SpanPatch(4, 12, 'bye\nto', 'x.txt')
+    >>> p.locate(_LineIndex(lines))
+    >>> print p.render_range()
+    x.txt:0-1
+    >>> p.replacement_lines(lines)
+    ['say bye\n', 'to the world\n']
+    >>> p.apply_to(lines)
+    >>> p = SpanPatch(15, 20, 'globe')
+    >>> p.locate(_LineIndex(lines))
+    >>> p.apply_to(lines)
+    >>> lines
+    ['say bye\n', 'to the globe\n']
+    """
+
+    __slots__ = ('start', 'end', 'replacement', 'applied_line_count',
+                 'start_col', 'end_col')
+
+    def __init__(self, start, end, replacement=None, path=None):
+        """
+        @param start        Offset of the first character of the range.
+        @param end          Offset just *after* the end of the range.
+        @param replacement  The string with which to replace the range, or
+                            None if the patch only flags it.
+        """
+        self.path = path
+        self.buffer = None
+        self.start = start
+        self.end = end
+        self.replacement = replacement
+        self.applied = False
+        self.rule = None
+        self.fingerprint = None
+        self.applied_line_count = None
+        self.start_line_number = self.end_line_number = None
+        self.start_col = self.end_col = None
+
+    def __repr__(self):
+        return 'SpanPatch(%s)' % ', '.join(map(repr, [
+            self.start,
+            self.end,
+            self.replacement,
+            self.path
+        ]))
+
+    def locate(self, index, start=None, end=None):
+        """
+        Works out the lines and columns of the range (optionally moving it to
+        [start, end) first), given a _LineIndex of the lines it applies to.
+        """
+        if start is not None:
+            self.start, self.end = start, end
+        start_row, self.start_col = index.row_col(self.start)
+        if self.end > self.start:
+            end_row, end_col = index.row_col(self.end - 1)
+            self.end_col = end_col + 1
+        else:
+            end_row, self.end_col = start_row, self.start_col
+        self.start_line_number = start_row
+        self.end_line_number = end_row + 1
+
+    @property
+    def start_position(self):
+        return Position(self.path, self.start_line_number, self.start_col)
+
+    @property
+    def new_lines(self):
+        if self.replacement is None:
+            return None
+        return self.replacement_lines(self.buffer.lines)
+
+    @property
+    def suggests_change(self):
+        return self.replacement is not None
+
+    def replacement_lines(self, lines):
+        if self.replacement is None:
+            return None
+        return _split_lines(''.join((
+            lines[self.start_line_number][:self.start_col],
+            self.replacement,
+            lines[self.end_line_number - 1][self.end_col:]
+        )))
+
+    def old_text(self, lines):
+        """Returns the text in the range, given the lines it applies to."""
+        if self.start_line_number == self.end_line_number - 1:
+            return lines[self.start_line_number][self.start_col:self.end_col]
+        return ''.join((
+            lines[self.start_line_number][self.start_col:],
+            ''.join(lines[self.start_line_number + 1:
+                          self.end_line_number - 1]),
+            lines[self.end_line_number - 1][:self.end_col]
+        ))
+
+    def is_noop(self, lines):
+        return (self.replacement is not None and
+                self.replacement == self.old_text(lines))
+
+    def apply_to(self, lines):
+        new_lines = self.replacement_lines(lines)
+        if new_lines is None:
+            raise ValueError('Can\'t apply patch without a replacement.')
+        lines[self.start_line_number:self.end_line_number] = new_lines
+        self.applied = True
+        self.applied_line_count = len(new_lines)
+
+
+class PatchSet(object):
+    r"""
+    A compact, append-only sequence of Patches and SpanPatches, for holding
+    many of them at once.  Their line numbers and offsets are kept in arrays,
+    and each distinct replacement, rule and path only once; the
+    patches themselves are made again as they are read, so changing one
+    doesn't change the set.
+
+    Only patches of exactly those two classes, not yet applied, can be added
+    (see `holds`), and the buffers they came with are not kept.
+
+    >>> patches = PatchSet([Patch(3, new_lines=['x\n']), SpanPatch(4, 6)])
+    >>> patches.append(Patch(5, new_lines=['x\n'], path='a.txt'))
+    >>> len(patches)
+    3
+    >>> for patch in patches:
+    ...     print patch
+    Patch(3, 4, ['x\n'], None)
+    SpanPatch(4, 6, None, None)
+    Patch(5, 6, ['x\n'], 'a.txt')
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(patches))[-1]
+    Patch(5, 6, ['x\n'], 'a.txt')
+    """
+
+    # Per patch, in _patches: its start and end lines, the numbers in
+    # self._values of its replacement and of its (rule, path), and for a
+    # SpanPatch the number of its start and end offsets and columns in
+    # _spans.  -1 stands for None.
+    _FIELDS = 5
+    _SPAN_FIELDS = 4
+    # (The largest number the arrays' 4-byte items hold.)
+    _LARGEST = 2 ** 31 - 1
+
+    def __init__(self, patches=()):
+        self._patches = array.array('i')
+        self._spans = array.array('i')
+        self._values = []
+        self._value_numbers = {}
+        for patch in patches:
+            self.append(patch)
+
+    @staticmethod
+    def holds(patch):
+        """Returns whether `patch` can be added to a PatchSet."""
+        return (type(patch) in (Patch, SpanPatch) and not patch.applied and
+                patch.fingerprint is None)
+
+    def append(self, patch):
+        """
+        Adds `patch`.  Raises TypeError if the set can't hold it, and
+        OverflowError if its offsets are too large.
+        """
+        if not self.holds(patch):
+            raise TypeError('Can\'t add %r to a PatchSet.' % (patch,))
+        span_fields = ()
+        if type(patch) is SpanPatch:
+            replacement = patch.replacement
+            span_fields = (patch.start, patch.end, patch.start_col,
+                           patch.end_col)
+            span = len(self._spans) // self._SPAN_FIELDS
+        else:
+            replacement = patch.new_lines
+            if replacement is not None:
+                replacement = (replacement[0] if len(replacement) == 1
+                               else tuple(replacement))
+            span = None
+        tag = None
+        if patch.rule is not None or patch.path is not None:
+            tag = patch.rule, patch.path
+        fields = (patch.start_line_number, patch.end_line_number,
+                  self._value_number(replacement), self._value_number(tag),
+                  span)
+        if any(number > self._LARGEST for number in fields + span_fields):
+            raise OverflowError('%r is too far into its file for a PatchSet.'
+                                % (patch,))
+        self._spans.extend(-1 if number is None else number
+                           for number in span_fields)
+        self._patches.extend(-1 if number is None else number
+                             for number in fields)
+
+    def _value_number(self, value):
+        if value is None:
+            return -1
+        if self._value_numbers is None:
+            self._value_numbers = dict(
+                (value, number) for number, value in enumerate(self._values)
+            )
+        number = self._value_numbers.get(value)
+        if number is None:
+            number = self._value_numbers[value] = len(self._values)
+            self._values.append(value)
+        return number
+
+    def __len__(self):
+        return len(self._patches) // self._FIELDS
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('PatchSet index out of range')
+        start_line, end_line, replacement, tag, span = [
+            None if number == -1 else number for number in
+            self._patches[i * self._FIELDS:(i + 1) * self._FIELDS]
+        ]
+        values = self._values
+        if replacement is not None:
+            replacement = values[replacement]
+        if span is not None:
+            start, end, start_col, end_col = [
+                None if number == -1 else number for number in
+                self._spans[span * self._SPAN_FIELDS:
+                            (span + 1) * self._SPAN_FIELDS]
+            ]
+            patch = SpanPatch(start, end, replacement)
+            patch.start_line_number = start_line
+            patch.end_line_number = end_line
+            patch.start_col, patch.end_col = start_col, end_col
+        else:
+            # (Stored as a line on its own, or a tuple of them.)
+            if isinstance(replacement, str):
+                replacement = [replacement]
+            elif replacement is not None:
+                replacement = list(replacement)
+            patch = Patch(start_line, end_line, replacement)
+        if tag is not None:
+            patch.rule, patch.path = values[tag]
+        return patch
+
+    def __getstate__(self):
+        # (Much smaller pickled than the arrays are by default.)
+        return (self._patches.tostring(), self._spans.tostring(),
+                self._values)
+
+    def __setstate__(self, state):
+        patches, spans, self._values = state
+        self._patches = array.array('i')
+        self._patches.fromstring(patches)
+        self._spans = array.array('i')
+        self._spans.fromstring(spans)
+        # (Only needed to add patches, and rebuilt then.)
+        self._value_numbers = None
+
+
+@_timed('draw')
 def print_patch(patch, lines_to_print, file_lines=None):
     if file_lines is None:
-        file_lines = list(open(patch.path))
+        file_lines = _patch_buffer(patch).lines
+    new_lines = patch.replacement_lines(file_lines)
 
     size_of_old = patch.end_line_number - patch.start_line_number
-    size_of_new = len(patch.new_lines) if patch.new_lines else 0
+    size_of_new = len(new_lines) if new_lines else 0
     size_of_diff = size_of_old + size_of_new
     size_of_context = max(0, lines_to_print - size_of_diff)
     size_of_up_context = int(size_of_context / 2)
@@ -311,20 +4714,19 @@ def print_patch(patch, lines_to_print, file_lines=None):
     start_context_line_number = patch.start_line_number - size_of_up_context
     end_context_line_number = patch.end_line_number + size_of_down_context
 
-    def print_file_line(line_number):  # noqa
-        # Why line_number is passed here?
-        print ('  %s' % file_lines[i]) if (
-            0 <= i < len(file_lines)) else '~\n',
+    def print_file_line(line_number):
+        terminal.write(('  %s' % file_lines[line_number]) if (
+            0 <= line_number < len(file_lines)) else '~\n')
 
     for i in xrange(start_context_line_number, patch.start_line_number):
         print_file_line(i)
     for i in xrange(patch.start_line_number, patch.end_line_number):
-        if patch.new_lines is not None:
+        if new_lines is not None:
             terminal_print('- %s' % file_lines[i], color='RED')
         else:
             terminal_print('* %s' % file_lines[i], color='YELLOW')
-    if patch.new_lines is not None:
-        for line in patch.new_lines:
+    if new_lines is not None:
+        for line in new_lines:
             terminal_print('+ %s' % line, color='GREEN')
     for i in xrange(patch.end_line_number, end_context_line_number):
         print_file_line(i)
@@ -335,40 +4737,65 @@ yes_to_all = False
 def _ask_about_patch(patch, editor, default_no):
     global yes_to_all
     default_action = 'n' if default_no else 'y'
-    terminal_clear()
-    terminal_print('%s\n' % patch.render_range(), color='WHITE')
-    print
+    buffer = _patch_buffer(patch)
 
-    lines = list(open(patch.path))
-    print_patch(patch, terminal_get_size()[0] - 20, lines)
+    # The whole screen, prompt included, goes out in one write.
+    with terminal.screen():
+        terminal_clear()
+        if patch.rule is not None:
+            terminal_print('%s  [%s]\n' % (patch.render_range(), patch.rule),
+                           color='WHITE')
+        else:
+            terminal_print('%s\n' % patch.render_range(), color='WHITE')
+        terminal.write('\n')
+        print_patch(patch, terminal_get_size()[0] - 20, buffer.lines)
+        terminal.write('\n')
 
-    print
+        if patch.suggests_change:
+            if not yes_to_all:
+                if default_no:
+                    terminal.write('Accept change (y = yes, n = no [default], '
+                                   'e = edit, A = yes to all, E = yes+edit)? ')
+                else:
+                    terminal.write('Accept change (y = yes [default], n = no, '
+                                   'e = edit, A = yes to all, E = yes+edit)? ')
+        else:
+            terminal.write('(e = edit [default], n = skip line)? ')
 
-    if patch.new_lines is not None:
+    if patch.suggests_change:
         if not yes_to_all:
-            if default_no:
-                print ('Accept change (y = yes, n = no [default], e = edit, ' +
-                       'A = yes to all, E = yes+edit)? '),
-            else:
-                print ('Accept change (y = yes [default], n = no, e = edit, ' +
-                       'A = yes to all, E = yes+edit)? '),
             p = _prompt('yneEA', default=default_action)
         else:
             p = 'y'
     else:
-        print '(e = edit [default], n = skip line)? ',
         p = _prompt('en', default='e')
 
     if p in 'A':
         yes_to_all = True
         p = 'y'
     if p in 'yE':
-        patch.apply_to(lines)
-        _save(patch.path, lines)
+        buffer.apply(patch)
     if p in 'eE':
+        # The editor has to see the changes accepted so far.
+        buffer.flush()
         run_editor(patch.start_position, editor)
+    return p
+
+
+def _patch_buffer(patch):
+    """
+    Returns the FileBuffer for the file a patch applies to, reading the file
+    only if the patch didn't come with one.
+    """
+    if patch.buffer is None:
+        patch.buffer = FileBuffer(patch.path)
+        return patch.buffer
+    if _stats is not None:
+        _stats.count('reads_saved')
+    return patch.buffer
 
 
+@_timed('prompt')
 def _prompt(letters='yn', default=None):
     """
     Wait for the user to type a character (and hit Enter).  If the user enters
@@ -388,16 +4815,98 @@ def _prompt(letters='yn', default=None):
         print 'Come again?'
 
 
-def _save(path, lines):
-    file_w = open(path, 'w')
-    for line in lines:
-        file_w.write(line)
-    file_w.close()
+@_timed('write')
+def _save(path, lines, fsync=False):
+    """
+    Replaces the file at `path` with `lines`.  The lines are written to a
+    temporary file first, so the file is never left half-written.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'a.sh')
+    >>> with open(path, 'w') as file_w:
+    ...     file_w.write('old\\n')
+    >>> os.chmod(path, 0750)
+    >>> _save(path, ['new\\n'])
+    >>> open(path).read(), oct(stat.S_IMODE(os.stat(path).st_mode))
+    ('new\\n', '0750')
 
+    If writing fails, the file is left as it was, with no temporary file
+    beside it:
 
+    >>> _save(path, ['newer\\n', None])    # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    TypeError: ...
+    >>> open(path).read(), os.listdir(directory)
+    ('new\\n', ['a.sh'])
+    """
+    file_w = _AtomicFile(path)
+    try:
+        file_w.file.writelines(lines)
+        file_w.commit(fsync)
+    except BaseException:
+        file_w.discard()
+        raise
+
+
+@_timed('editor')
 def run_editor(position, editor=None):
+    """
+    Opens the editor at a Position (see Patch.start_position).
+    """
+    import pipes
+    editor = editor or os.environ.get('EDITOR') or 'vim'
+    os.system('%s +%d %s' % (editor, position.line_number + 1,
+                             pipes.quote(position.path)))
+
+
+@_timed('editor')
+def run_quickfix_editor(path, editor=None):
+    """
+    Opens the editor once on the quickfix file at `path` (see quickfix_line):
+    vim (and its relatives) load it as the quickfix list, and emacs shows it
+    in compilation mode, so that each location is a `:cn` or `next-error`
+    away.  Other editors just open the file.
+    """
+    import pipes
     editor = editor or os.environ.get('EDITOR') or 'vim'
-    os.system('%s +%d %s' % (editor, position.line_number + 1, position.path))
+    words = editor.split()
+    name = os.path.basename(words[0]) if words else ''
+    if name in ('vi', 'vim', 'nvim', 'gvim', 'mvim'):
+        command = '%s -q %s' % (editor, pipes.quote(path))
+    elif 'emacs' in name:
+        command = '%s %s --eval %s' % (editor, pipes.quote(path),
+                                       pipes.quote('(compilation-mode)'))
+    else:
+        command = '%s %s' % (editor, pipes.quote(path))
+    os.system(command)
+
+
+def quickfix_line(patch, lines, path=None):
+    r"""
+    Returns a line locating `patch` in the `path:line:column: text` format of
+    vim's quickfix list and emacs's compilation mode, where text is the first
+    line it applies to, among `lines`.  Line and column count from 1.
+
+    >>> print quickfix_line(Patch(1, path='a.py'), ['x\n', '  f(y)\n']),
+    a.py:2:1: f(y)
+    >>> patch = SpanPatch(6, 7, path='a.py')
+    >>> patch.locate(_LineIndex(['x\n', '  f(y)\n']))
+    >>> patch.rule = 'no-y'
+    >>> print quickfix_line(patch, ['x\n', '  f(y)\n']),
+    a.py:2:5: [no-y] f(y)
+    """
+    position = patch.start_position
+    if 0 <= position.line_number < len(lines):
+        text = lines[position.line_number].strip()
+    else:
+        text = ''
+    if patch.rule is not None:
+        text = '[%s] %s' % (patch.rule, text)
+    return '%s:%d:%d: %s\n' % (path or position.path,
+                               position.line_number + 1,
+                               position.column + 1, text)
 
 
 #
@@ -405,11 +4914,152 @@ def run_editor(position, editor=None):
 # standalone library.
 #
 
+class Terminal(object):
+    """
+    The terminal modone draws on.  curses is only loaded, and the terminal's
+    capabilities looked up, the first time an escape sequence is needed;
+    after that, sequences are cached.  The size is looked up when first
+    needed and again only after the terminal has been resized (SIGWINCH).
+
+    Output is normally written straight to standard output, but while a
+    `screen` is being drawn it's collected and written all at once.
+    """
+
+    COLORS = 'BLACK RED GREEN YELLOW BLUE MAGENTA CYAN WHITE'
+    # The order of colors for the older `setf` capability.
+    SETF_COLORS = 'BLACK BLUE GREEN CYAN RED MAGENTA YELLOW WHITE'
+
+    def __init__(self):
+        self._curses = None
+        self._usable = False
+        self._capabilities = {}
+        self._size = None
+        self._watching_size = False
+        self._screen = None
+
+    def _load(self):
+        """
+        Loads curses and the terminal's description, if that hasn't been done
+        yet.  Returns whether there is a terminal with capabilities to use.
+        """
+        if self._curses is None:
+            import curses
+            try:
+                curses.setupterm()
+                self._usable = True
+            except curses.error:
+                pass
+            self._curses = curses
+        return self._usable
+
+    def capability(self, name):
+        """
+        Returns the escape sequence for the given terminfo capability, or ''
+        if the terminal doesn't have it.
+        """
+        try:
+            return self._capabilities[name]
+        except KeyError:
+            sequence = ''
+            if self._load():
+                sequence = self._curses.tigetstr(name) or ''
+            self._capabilities[name] = sequence
+            return sequence
+
+    def color(self, color):
+        """
+        Returns the escape sequence that sets the foreground color to `color`
+        (one of COLORS), or '' if that can't be done.
+        """
+        key = 'color', color
+        try:
+            return self._capabilities[key]
+        except KeyError:
+            sequence = (self._color_code('setaf', self.COLORS, color) or
+                        self._color_code('setf', self.SETF_COLORS, color))
+            self._capabilities[key] = sequence
+            return sequence
+
+    def _color_code(self, set_capability, possible_colors, color):
+        try:
+            color_index = possible_colors.split(' ').index(color)
+        except ValueError:
+            return ''
+        set_code = self.capability(set_capability)
+        if not set_code:
+            return ''
+        return self._curses.tparm(set_code, color_index)
+
+    def size(self, default_size=(25, 80)):
+        """
+        Returns [number of rows, number of columns] for the terminal, if they
+        can be determined, or `default_size` if they can't.
+        """
+        if self._size is None:
+            self._watch_size()
+            self._size = _query_terminal_size() or list(default_size)
+        return self._size
+
+    def _watch_size(self):
+        if self._watching_size:
+            return
+        self._watching_size = True
+        try:
+            signal.signal(signal.SIGWINCH, self._resized)
+            # Don't interrupt a prompt waiting for input.
+            signal.siginterrupt(signal.SIGWINCH, False)
+        except (AttributeError, ValueError):
+            # No SIGWINCH here, or not on the main thread: the size is looked
+            # up once.
+            pass
+
+    def _resized(self, signal_number, frame):
+        self._size = None
+
+    def write(self, text):
+        if self._screen is not None:
+            self._screen.append(text)
+        else:
+            sys.stdout.write(text)
+
+    @contextlib.contextmanager
+    def screen(self):
+        """
+        Collects everything written to the terminal within the `with` block,
+        and writes it out with a single write when the block is done.
+        """
+        if self._screen is not None:
+            yield
+            return
+        self._screen = []
+        try:
+            yield
+        finally:
+            screen, self._screen = self._screen, None
+            self._flush_screen(screen)
+
+    @_timed('draw')
+    def _flush_screen(self, screen):
+        sys.stdout.write(''.join(screen))
+        sys.stdout.flush()
+
+
+terminal = Terminal()
+
+
 def terminal_get_size(default_size=(25, 80)):
     """
     Return (number of rows, number of columns) for the terminal,
     if they can be determined, or `default_size` if they can't.
     """
+    return terminal.size(default_size)
+
+
+def _query_terminal_size():
+    """
+    Asks the terminal for its size, returning [rows, columns], or None if it
+    can't be determined.
+    """
 
     def ioctl_gwinsz(fd):  # TABULATION FUNCTIONS
         try:  # Discover terminal width
@@ -433,30 +5083,32 @@ def terminal_get_size(default_size=(25, 80)):
         except Exception:
             pass
     if not size:
-        # env vars or finally defaults
+        # env vars
         try:
-            size = (os.environ.get('LINES'), os.environ.get('COLUMNS'))
-        except Exception:
-            return default_size
+            size = (int(os.environ['LINES']), int(os.environ['COLUMNS']))
+        except (KeyError, ValueError):
+            return None
 
     return map(int, size)
 
 
+@_timed('draw')
 def terminal_clear():
     """
     Like calling the `clear` UNIX command.  If that fails, just prints a bunch
     of newlines :-P
     """
     if not _terminal_use_capability('clear'):
-        print '\n' * 8
+        terminal.write('\n' * 9)
 
 
+@_timed('draw')
 def terminal_move_to_beginning_of_line():
     """
     Jumps the cursor back to the beginning of the current line of text.
     """
     if not _terminal_use_capability('cr'):
-        print
+        terminal.write('\n')
 
 
 def _terminal_use_capability(capability_name):
@@ -464,47 +5116,16 @@ def _terminal_use_capability(capability_name):
     If the terminal supports the given capability, output it.  Return whether
     it was output.
     """
-    import curses
-    curses.setupterm()
-    capability = curses.tigetstr(capability_name)
+    capability = terminal.capability(capability_name)
     if capability:
-        sys.stdout.write(capability)
+        terminal.write(capability)
     return bool(capability)
 
 
+@_timed('draw')
 def terminal_print(text, color):
     """Print text in the specified color, without a terminating newline."""
-    _terminal_set_color(color)
-    print text,
-    _terminal_restore_color()
-
-
-def _terminal_set_color(color):
-    import curses
-
-    def color_code(set_capability, possible_colors):
-        try:
-            color_index = possible_colors.split(' ').index(color)
-        except ValueError:
-            return None
-        set_code = curses.tigetstr(set_capability)
-        if not set_code:
-            return None
-        return curses.tparm(set_code, color_index)
-    code = (
-        color_code(
-            'setaf', 'BLACK RED GREEN YELLOW BLUE MAGENTA CYAN WHITE'
-        ) or color_code(
-            'setf', 'BLACK BLUE GREEN CYAN RED MAGENTA YELLOW WHITE'
-        )
-    )
-    if code:
-        sys.stdout.write(code)
-
-
-def _terminal_restore_color():
-    import curses
-    sys.stdout.write(curses.tigetstr('sgr0'))
+    terminal.write(terminal.color(color) + text + terminal.capability('sgr0'))
 
 #
 # Code to make this run as an executable from the command line.
@@ -554,17 +5175,94 @@ def _parse_command_line():
                              'line at a time.')
     parser.add_argument('-i', action='store_true',
                         help='Perform case-insensitive search.')
+    parser.add_argument('--overlapping', action='store_true', default=None,
+                        help='With -m (or multiline rules), also suggest '
+                             'matches that overlap earlier ones, searching '
+                             'again just after the start of each match.  '
+                             'This is the default unless --accept-all is '
+                             'given.')
+    parser.add_argument('--no-overlapping', action='store_false',
+                        dest='overlapping',
+                        help='With -m (or multiline rules), carry on from '
+                             'the end of each match, as re.sub does.  This '
+                             'is the default with --accept-all.')
 
-    parser.add_argument('--path', action='store', type=str)
+    parser.add_argument('--path', action='append', type=str,
+                        help='File to operate on.  May be given more than '
+                             'once.')
+    parser.add_argument('--paths-from', action='store', type=str,
+                        metavar='FILE',
+                        help='Read the paths to operate on from FILE, one per '
+                             'line ("-" for standard input).  Paths are '
+                             'processed as they are read, so this can be fed '
+                             'directly by `find` or `grep -l`.')
+    parser.add_argument('-0', action='store_true', dest='null',
+                        help='Paths read with --paths-from are separated by '
+                             'NUL characters (as with `find -print0` or '
+                             '`grep -lZ`) instead of newlines.')
+    parser.add_argument('--root', action='append', type=str, metavar='DIR',
+                        help='Operate on the files under DIR, skipping those '
+                             'ignored by .gitignore files.  May be given '
+                             'more than once.')
+    parser.add_argument('--include', action='append', type=str,
+                        metavar='GLOB', default=[],
+                        help='With --root, only operate on files whose name '
+                             'or path under the root matches GLOB (e.g. '
+                             '"*.js").  May be given more than once.')
+    parser.add_argument('--exclude', action='append', type=str,
+                        metavar='GLOB', default=[],
+                        help='With --root, skip files and directories whose '
+                             'name or path under the root matches GLOB.  May '
+                             'be given more than once.')
+    parser.add_argument('--no-gitignore', action='store_false',
+                        dest='gitignore',
+                        help='With --root, don\'t skip files ignored by '
+                             '.gitignore files.')
 
     parser.add_argument('--accept-all', action='store_true',
                         help='Automatically accept all '
                              'changes (use with caution).')
 
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                        help='Use this many worker processes: to apply '
+                             'patches with --accept-all and a substitution, '
+                             'to write them with --export, or otherwise to '
+                             'read and search the files to review, sending '
+                             'back only those with matches.')
+
+    parser.add_argument('--fsync', action='store_true',
+                        help='Make sure each changed file has reached the '
+                             'disk before moving on.')
+
+    parser.add_argument('--timeout', action='store', type=float,
+                        metavar='SECONDS',
+                        help='Skip (and report) any file that takes longer '
+                             'than SECONDS to search.  Files are then '
+                             'searched in worker processes that can be '
+                             'stopped.  Applies to --count, --accept-all and '
+                             '--export, and to reviewing with -j.')
+    parser.add_argument('--match-timeout', action='store', type=float,
+                        metavar='SECONDS',
+                        help='Like --timeout, but for a single line (or, '
+                             'with -m, a single search), to catch regexes '
+                             'that backtrack catastrophically.')
+
     parser.add_argument('--default-no', action='store_true',
                         help='If set, this will make the default '
                              'option to not accept the change.')
 
+    parser.add_argument('--prefetch', action='store', type=int, default=4,
+                        metavar='N',
+                        help='While you review a file, get up to N files with '
+                             'matches ready in the background (default 4; 0 '
+                             'turns this off).')
+
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Don\'t use (or update) the cache of files '
+                             'known to have nothing to suggest and of '
+                             'rejected patches, kept in %s.' % (
+                                 default_cache_path().replace('%', '%%')))
+
     parser.add_argument('--editor', action='store', type=str,
                         help='Specify an editor, e.g. "vim" or emacs". '
                         'If omitted, defaults to $EDITOR environment '
@@ -573,9 +5271,64 @@ def _parse_command_line():
                         help='Don\'t run normally.  Instead, just print '
                              'out number of times places in the codebase '
                              'where the \'query\' matches.')
+    parser.add_argument('--mmap', action='store_true',
+                        help='With --count or --accept-all, memory-map each '
+                             'file and run the regex over it directly rather '
+                             'than reading it into a list of lines.  Meant '
+                             'for very large files.')
+    parser.add_argument('--stream', action='store_true',
+                        help='With --count, --accept-all or --export, and '
+                             'without -m or --rules, read (and write) each '
+                             'file a line at a time, so that memory use '
+                             'stays the same however big the files are.')
+    parser.add_argument('--json', action='store_true',
+                        help='With --count, print the counts as a JSON '
+                             'object.')
+    parser.add_argument('--export', choices=['diff', 'jsonl', 'quickfix'],
+                        help='Don\'t run normally.  Instead, write out every '
+                             'suggested patch, as a unified diff or as JSON '
+                             'lines, to be reviewed and applied later with '
+                             '--apply-from, or as `path:line:column: text` '
+                             'lines for vim\'s quickfix list (vim -q) or '
+                             'emacs\'s compilation mode.')
+    parser.add_argument('--quickfix', action='store_true',
+                        help='Don\'t ask about matches without a suggested '
+                             'change one at a time.  Once the rest have been '
+                             'reviewed, open the editor once with all of '
+                             'them in its quickfix list (vim) or in '
+                             'compilation mode (emacs).')
+    parser.add_argument('--context', action='store', type=int, default=3,
+                        help='Lines of context in --export diff output.')
+    parser.add_argument('--apply-from', action='store', type=str,
+                        metavar='FILE',
+                        help='Don\'t run normally.  Instead, apply the '
+                             'patches in FILE ("-" for standard input), as '
+                             'written by --export, after checking that the '
+                             'files haven\'t changed since.')
+    parser.add_argument('--stats', action='store_true',
+                        help='When done, print to standard error where the '
+                             'time went (reading, matching, drawing, '
+                             'writing...), how much was read and written, '
+                             'and the slowest files.')
+    parser.add_argument('--stats-json', action='store_true',
+                        help='Like --stats, but print them as JSON.')
     parser.add_argument('--test', action='store_true',
                         help='Don\'t run normally.  Instead, just run '
                              'the unit tests embedded in the modone library.')
+    parser.add_argument('--serve', nargs='?', const='', metavar='SOCKET',
+                        help='Don\'t run normally.  Instead, answer queries '
+                             'from modone-client over the Unix socket '
+                             'SOCKET (by default modone-UID.sock in '
+                             '$XDG_RUNTIME_DIR or the temporary directory), '
+                             'keeping compiled regexes and file contents '
+                             'between them.')
+
+    parser.add_argument('--rules', action='store', type=str, metavar='FILE',
+                        help='Instead of a regex and substitution, check '
+                             'every rule in FILE in one pass over each file.  '
+                             'FILE holds a JSON list of objects with a '
+                             '"pattern" and optionally a "substitution", '
+                             '"name", "ignore_case" and "multiline".')
 
     parser.add_argument('match', nargs='?', action='store', type=str,
                         help='Regular expression to match.')
@@ -589,32 +5342,261 @@ def _parse_command_line():
         doctest.testmod(verbose=True)
         sys.exit(0)
 
-    if arguments.path is None:
+    if arguments.stats or arguments.stats_json:
+        import atexit
+        enable_stats()
+        atexit.register(_print_stats,
+                        'json' if arguments.stats_json else 'text')
+
+    if arguments.serve is not None:
+        options = {'socket_path': arguments.serve or default_socket_path()}
+        if not arguments.no_cache:
+            options['cache'] = ScanCache(default_cache_path())
+        return run_serve, options
+
+    if arguments.apply_from is not None:
+        stream = (sys.stdin if arguments.apply_from == '-'
+                  else open(arguments.apply_from))
+        return run_apply_from, {'stream': stream, 'fsync': arguments.fsync}
+
+    if (arguments.path is None and arguments.paths_from is None and
+            arguments.root is None):
         parser.print_usage()
         sys.exit(0)
 
     yes_to_all = arguments.accept_all
+    overlapping = arguments.overlapping
+    if overlapping is None:
+        overlapping = not arguments.accept_all
 
     query_options = {}
 
-    query_options['suggestor'] = (
-        multiline_regex_suggestor if arguments.m else regex_suggestor
-    )(arguments.match, arguments.subst, arguments.i)
-    query_options['path'] = arguments.path
+    if arguments.rules is not None:
+        if arguments.match is not None:
+            parser.error('--rules replaces the regex and substitution')
+        if arguments.mmap or arguments.stream:
+            parser.error('--mmap and --stream can\'t be used with --rules')
+        try:
+            with open(arguments.rules) as rules_file:
+                rules = load_rules(rules_file, overlapping)
+        except (IOError, ValueError) as e:
+            parser.error('%s: %s' % (arguments.rules, e))
+        query_options['suggestor'] = rules_suggestor(rules)
+        has_substitution = any(rule.substitution is not None
+                               for rule in rules)
+    elif arguments.m:
+        query_options['suggestor'] = multiline_regex_suggestor(
+            arguments.match, arguments.subst, arguments.i, overlapping
+        )
+        has_substitution = arguments.subst is not None
+    else:
+        query_options['suggestor'] = regex_suggestor(
+            arguments.match, arguments.subst, arguments.i
+        )
+        has_substitution = arguments.subst is not None
+    query_options['paths'] = list(arguments.path or [])
+    query_options['file_budget'] = arguments.timeout
+    query_options['match_budget'] = arguments.match_timeout
+    if not arguments.no_cache:
+        import atexit
+        cache = ScanCache(default_cache_path())
+        atexit.register(_save_cache, cache)
+        query_options['cache'] = cache
+    if arguments.mmap:
+        if not (arguments.count or
+                (arguments.accept_all and has_substitution)):
+            parser.error('--mmap needs --count, or --accept-all and a '
+                         'substitution')
+        query_options['engine'] = 'mmap'
+    if arguments.stream:
+        if arguments.mmap or arguments.m:
+            parser.error('--stream can\'t be used with --mmap or -m')
+        if not (arguments.count or arguments.export or
+                (arguments.accept_all and has_substitution)):
+            parser.error('--stream needs --count, --export, or --accept-all '
+                         'and a substitution')
+        if arguments.export == 'quickfix':
+            parser.error('--stream can\'t be used with --export quickfix')
+        query_options['engine'] = 'stream'
+
+    if arguments.paths_from is not None:
+        if arguments.paths_from == '-':
+            # Mirrors the choice of run function below: only
+            # run_interactive prompts, including --accept-all without a
+            # substitution.
+            prompts = not (arguments.export is not None or arguments.count or
+                           (arguments.accept_all and has_substitution))
+            paths_file = _detach_stdin(interactive=prompts)
+            if paths_file is None:
+                parser.error('--paths-from - needs a terminal to prompt on')
+        else:
+            paths_file = open(arguments.paths_from, 'rb')
+        query_options['paths'] = itertools.chain(
+            query_options['paths'],
+            read_paths(paths_file, '\0' if arguments.null else '\n')
+        )
+    if arguments.root is not None:
+        query_options['paths'] = itertools.chain(
+            query_options['paths'],
+            walk_tree(arguments.root, arguments.include, arguments.exclude,
+                      arguments.gitignore)
+        )
+    elif arguments.include or arguments.exclude:
+        parser.error('--include and --exclude need --root')
 
     options = {}
     options['query'] = Query(**query_options)
+
+    if arguments.export is not None:
+        options['format'] = arguments.export
+        options['jobs'] = max(1, arguments.jobs)
+        options['context'] = arguments.context
+        return run_export, options
+
+    if arguments.accept_all and has_substitution and not arguments.count:
+        options['jobs'] = max(1, arguments.jobs)
+        options['fsync'] = arguments.fsync
+        return run_headless, options
+
+    if arguments.count:
+        options['as_json'] = arguments.json
+        return run_count, options
+
+    options['query'].prefetch = max(0, arguments.prefetch)
+    options['query'].jobs = max(1, arguments.jobs)
     if arguments.editor is not None:
         options['editor'] = arguments.editor
-    options['just_count'] = arguments.count
     options['default_no'] = arguments.default_no
+    options['fsync'] = arguments.fsync
+    options['quickfix'] = arguments.quickfix
+
+    return run_interactive, options
+
 
-    return options
+def _save_cache(cache):
+    try:
+        cache.save()
+    except EnvironmentError as e:
+        sys.stderr.write('Couldn\'t save the cache: %s\n' % e)
+
+
+def _detach_stdin(interactive):
+    """
+    Returns a file object reading what was standard input.  If `interactive`,
+    the controlling terminal is put in its place as file descriptor 0, so that
+    both prompts and the editor talk to the user rather than to the pipe the
+    paths are coming from (this is what `xargs -o` used to do for us).
+    Returns None if that isn't possible.
+    """
+    paths_file = os.fdopen(os.dup(0), 'rb')
+    if interactive:
+        try:
+            tty_fd = os.open('/dev/tty', os.O_RDONLY)
+        except OSError:
+            return None
+        os.dup2(tty_fd, 0)
+        os.close(tty_fd)
+    return paths_file
 
 
 def main():
-    options = _parse_command_line()
-    run_interactive(**options)
+    run, options = _parse_command_line()
+    run(**options)
+
+
+def client_main():
+    """
+    modone-client: sends a query to `modone --serve` and prints the answer
+    the way modone would.
+    """
+    import socket
+
+    parser = argparse.ArgumentParser(
+        description='Runs a modone query on a running `modone --serve`, '
+                    'without the cost of starting modone.'
+    )
+    parser.add_argument('--socket', action='store', type=str,
+                        default=default_socket_path(),
+                        help='The server\'s socket (default %s).' % (
+                            default_socket_path().replace('%', '%%')))
+    parser.add_argument('-m', action='store_true',
+                        help='Have regex work over multiple lines.')
+    parser.add_argument('-i', action='store_true',
+                        help='Perform case-insensitive search.')
+    parser.add_argument('--path', action='append', type=str, default=[],
+                        help='File to operate on.  May be given more than '
+                             'once.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--count', action='store_true',
+                      help='Print the number of matches in each file (the '
+                           'default).')
+    mode.add_argument('--accept-all', action='store_true',
+                      help='Apply every suggested change.')
+    mode.add_argument('--export', choices=['diff', 'jsonl', 'quickfix'],
+                      help='Write out every suggested patch (see modone '
+                           '--export).')
+    parser.add_argument('--context', action='store', type=int, default=3,
+                        help='Lines of context in --export diff output.')
+    parser.add_argument('--fsync', action='store_true',
+                        help='Make sure each changed file has reached the '
+                             'disk before the server answers.')
+    parser.add_argument('match', action='store', type=str,
+                        help='Regular expression to match.')
+    parser.add_argument('subst', nargs='?', action='store', type=str,
+                        help='Substitution to replace with.')
+    arguments = parser.parse_args()
+
+    request = {
+        'pattern': arguments.match,
+        'substitution': arguments.subst,
+        'multiline': arguments.m,
+        'ignore_case': arguments.i,
+        'cwd': os.getcwd(),
+        'paths': arguments.path,
+    }
+    if arguments.export is not None:
+        request.update(mode='export', format=arguments.export,
+                       context=arguments.context)
+    elif arguments.accept_all:
+        if arguments.subst is None:
+            parser.error('--accept-all needs a substitution')
+        request.update(mode='apply', fsync=arguments.fsync)
+    else:
+        request['mode'] = 'count'
+
+    try:
+        response = query_server(arguments.socket, request)
+    except socket.error as e:
+        sys.stderr.write('Couldn\'t reach a modone server at %s (%s); start '
+                         'one with `modone --serve`.\n' % (
+                             arguments.socket, e))
+        sys.exit(2)
+    if 'error' in response:
+        sys.stderr.write('modone server: %s\n' % response['error'])
+        sys.exit(2)
+
+    failed = False
+    total = files_changed = 0
+    for result in response['results']:
+        path = result['path']
+        if 'error' in result:
+            sys.stderr.write('%s: %s\n' % (path, result['error']))
+            failed = True
+        elif request['mode'] == 'count':
+            if result['count']:
+                print '%s\t%d' % (path, result['count'])
+            total += result['count']
+        elif request['mode'] == 'export':
+            sys.stdout.write(result['output'])
+        elif result['applied']:
+            _print_applied(path, result['applied'])
+            files_changed += 1
+            total += result['applied']
+    if request['mode'] == 'count':
+        print 'total\t%d' % total
+    elif request['mode'] == 'apply':
+        _print_applied_summary(files_changed, total)
+    sys.exit(1 if failed else 0)
 
 if __name__ == '__main__':
     main()
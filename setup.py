@@ -16,13 +16,14 @@ setup(
     author_email="indigoviolet@gmail.com",
     description=description,
     long_description=description,
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     zip_safe=False,
     platforms='any',
     entry_points='''
         [console_scripts]
         modone=modone.base:main
+        modone-client=modone.base:client_main
     ''',
     tests_require=['flake8', 'pytest'],
     test_suite='py.test'